@@ -0,0 +1,124 @@
+"""
+Benchmark the test discovery of the distributor
+
+Generates synthetic Robot Framework projects with 1k/10k/100k tests
+(100 tests per suite file), runs the same dry run as the distributor
+with the DistributorListener and reports the discovery time and the peak RSS.
+
+Every measurement runs in a fresh python process, so the peak RSS of one
+case does not leak into the next one.
+
+With pandas and numpy installed, the previous DataFrame based collector
+(one pd.concat per test) is measured as "before" for comparison.
+
+Usage:
+    python benchmarks/bench_distributor_discovery.py [--sizes 1000 10000 100000] [--shards 100]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS_PER_SUITE = 100
+
+
+def generate_project(path, tests):
+    os.makedirs(path, exist_ok=True)
+    for suite_number in range(max(1, tests // TESTS_PER_SUITE)):
+        with open(os.path.join(path, f"suite_{suite_number:05d}.robot"), "w") as f:
+            f.write("*** Test Cases ***\n")
+            for test_number in range(min(tests, TESTS_PER_SUITE)):
+                f.write(f"Test {test_number:03d}\n    Log    {suite_number} {test_number}\n")
+
+
+def measure(implementation, project, shards):
+    """Runs in a child process, prints one line of json"""
+    sys.path.insert(0, os.path.join(REPO_ROOT, "distributor"))
+    from robot import run
+    from Listener.DistributorListener import DistributorListener
+
+    listener_class = DistributorListener
+    if implementation == "before":
+        listener_class = legacy_listener_class(DistributorListener)
+    output = tempfile.mkdtemp() + "/"
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            run(project, dryrun=True, listener=listener_class(shards, output), output=None, log=None,
+                report=None, runemptysuite=True, quiet=True)
+        finally:
+            sys.stdout = stdout
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "seconds": elapsed,
+        # ru_maxrss is in kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "shards": len(os.listdir(output)),
+    }))
+
+
+def legacy_listener_class(base):
+    import numpy as np
+    import pandas as pd
+
+    class LegacyDistributorListener(base):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.frame = pd.DataFrame(columns=["suite", "test", "datadriver"])
+
+        def end_suite(self, suite, result):
+            for test in suite.tests:
+                self.frame = pd.concat(
+                    [self.frame, pd.DataFrame([[suite.longname, test.name, self.uses_datadriver]],
+                                              columns=["suite", "test", "datadriver"])],
+                    ignore_index=True,
+                )
+
+        def close(self):
+            grouped_tests = self.frame.groupby("suite")
+            grouped_tests_nodes = (grouped_tests.size() / len(self.frame) * self.nodes).apply(lambda x: max(1, round(x)))
+            for suite, chunks in grouped_tests.apply(lambda x: np.array_split(x, grouped_tests_nodes[x.name])).items():
+                for chunk_number, chunk in enumerate(chunks, start=1):
+                    filename = "distributor_" + suite.replace(" ", "_") + "_" + "{:03d}".format(chunk_number) + ".json"
+                    chunk.to_json(self.outputpath + filename, orient="records")
+
+    return LegacyDistributorListener
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--shards", type=int, default=100)
+    args = parser.parse_args()
+    try:
+        import pandas  # noqa: F401
+        implementations = ["before", "after"]
+    except ImportError:
+        implementations = ["after"]
+
+    print(f"{'tests':>8} {'implementation':>15} {'seconds':>10} {'peak RSS MB':>12} {'shards':>7}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            project = os.path.join(workdir, f"project_{size}")
+            generate_project(project, size)
+            for implementation in implementations:
+                output = subprocess.run(
+                    [sys.executable, __file__, "--measure", implementation, project, str(args.shards)],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{size:>8} {implementation:>15} {result['seconds']:>10.2f} "
+                      f"{result['peak_rss_mb']:>12.1f} {result['shards']:>7}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main()
@@ -0,0 +1,113 @@
+"""
+Benchmark the fan-out of the distributor into DynamoDB and SQS
+
+Starts a local moto server with the TestRunTable, the TestShardTable and the
+TestJobQueue and measures the time to enqueue 100/1,000/5,000 shards:
+
+- sequential: one put_item per table and one send_message per shard,
+  like the distributor did before
+- batched: distributor/fanout.py with batch_write_item and send_message_batch
+
+Use --latency-ms to add a fixed delay to every request, the local server
+answers much faster than DynamoDB and SQS in a Lambda function.
+
+Requires moto[server] and boto3.
+
+Usage:
+    python benchmarks/bench_distributor_fanout.py [--shards 100 1000 5000] [--latency-ms 10]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "distributor"))
+sys.path.insert(0, os.path.join(REPO_ROOT, "shared"))
+
+
+def shard_records(run_id, shards):
+    for number in range(shards):
+        job_id = str(uuid.uuid4())
+        shard_content = [{"suite": f"Tests.Suite {number}", "test": f"Test {test}", "datadriver": False} for test in range(10)]
+        yield (
+            {'run_id': run_id, 'job_status': 'NOT STARTED', 'job_id': job_id, 'shards': shards},
+            {'run_id': run_id, 'shard_name': f'distributor_{number:05d}', 'shard_content': shard_content, 'job_id': job_id},
+            {'MessageBody': json.dumps({'run_id': run_id, 'job_id': job_id, 'shard_content': shard_content}),
+             'MessageAttributes': {'run_id': {'DataType': 'String', 'StringValue': run_id}}},
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    os.environ.update({
+        "AWS_ENDPOINT_URL": f"http://{host}:{port}",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    })
+    import boto3
+    import fanout
+
+    def delay(**kwargs):
+        time.sleep(args.latency_ms / 1000)
+
+    try:
+        dynamodb_client, sqs_client = fanout.clients()
+        for client in (dynamodb_client, sqs_client):
+            if args.latency_ms:
+                client.meta.events.register("before-send", delay)
+        dynamodb_client.create_table(
+            TableName="TestRunTable", BillingMode="PAY_PER_REQUEST",
+            AttributeDefinitions=[{"AttributeName": "run_id", "AttributeType": "S"}, {"AttributeName": "job_id", "AttributeType": "S"}],
+            KeySchema=[{"AttributeName": "run_id", "KeyType": "HASH"}, {"AttributeName": "job_id", "KeyType": "RANGE"}])
+        dynamodb_client.create_table(
+            TableName="TestShardTable", BillingMode="PAY_PER_REQUEST",
+            AttributeDefinitions=[{"AttributeName": "job_id", "AttributeType": "S"}],
+            KeySchema=[{"AttributeName": "job_id", "KeyType": "HASH"}])
+        queue_url = sqs_client.create_queue(QueueName="TestJobQueue")["QueueUrl"]
+
+        dynamodb = boto3.resource("dynamodb")
+        test_run_table = dynamodb.Table("TestRunTable")
+        test_shard_table = dynamodb.Table("TestShardTable")
+        sequential_sqs = boto3.client("sqs")
+        if args.latency_ms:
+            dynamodb.meta.client.meta.events.register("before-send", delay)
+            sequential_sqs.meta.events.register("before-send", delay)
+
+        print(f"{'shards':>7} {'sequential s':>13} {'batched s':>10} {'speedup':>8}")
+        for shards in args.shards:
+            records = list(shard_records(str(uuid.uuid4()), shards))
+            start = time.perf_counter()
+            for run_item, shard_item, message in records:
+                test_run_table.put_item(Item=run_item)
+                test_shard_table.put_item(Item=shard_item)
+                sequential_sqs.send_message(QueueUrl=queue_url, **message)
+            sequential = time.perf_counter() - start
+
+            records = list(shard_records(str(uuid.uuid4()), shards))
+            start = time.perf_counter()
+            items = []
+            for run_item, shard_item, _ in records:
+                items += [("TestRunTable", run_item), ("TestShardTable", shard_item)]
+            fanout.put_items(dynamodb_client, items)
+            fanout.send_messages(sqs_client, queue_url, [message for _, _, message in records])
+            batched = time.perf_counter() - start
+            print(f"{shards:>7} {sequential:>13.2f} {batched:>10.2f} {sequential / batched:>7.1f}x")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+End-to-end benchmark of the distributor -> executor -> merger pipeline
+
+Runs the lambda_handler of all three functions locally against a moto server,
+which stands in for S3, SQS and DynamoDB:
+
+- generates a synthetic Robot Framework project with --suites x --tests tests,
+  the first --datadriver-suites suites generate their tests with DataDriver from a CSV file
+- invokes the distributor like the API Gateway does
+- polls the queue like the SQS event source (with --dispatch pull the executors receive
+  the work units from the WorkUnitQueue themselves) and sends batches of up to --batch-size messages
+  to --executors executor processes, every process stands for one warm Lambda container
+  with its own project cache
+- runs the merger for every asynchronous invocation by the executors
+  (merge groups and the final merge) and requests the status of the merged run
+
+Reports the end-to-end wall time and per function the invocations, the time of every phase
+(read from the EMF lines of rflambda.metrics), the S3 bytes and the peak RSS,
+and the AWS requests per operation. --json writes the report to a file, so runs can be tracked over time.
+The project is generated with a fixed seed, the same arguments result in the same project.
+
+Use --latency-ms to add a fixed delay to every AWS request, the local server answers much faster than AWS.
+Like in Lambda, the functions write their scratch files to /tmp, below /tmp/results and /tmp/bench.
+
+Requires moto[server], boto3 and the dependencies of the three functions
+(robotframework, robotframework-datadriver, allure-robotframework).
+
+Usage:
+    python benchmarks/bench_e2e.py [--suites 10] [--tests 20] [--datadriver-suites 2] [--shards 8] [--executors 4] [--dispatch pull]
+"""
+import argparse
+import collections
+import contextlib
+import importlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT = "bench"
+
+# State of a worker process, set by init_worker
+_handler = None
+_requests = collections.Counter()
+
+
+def generate_project(path, suites, tests, datadriver_suites, sleep, fail_rate, seed):
+    """Write a project with one suite file per suite below path/tests"""
+    rng = random.Random(seed)
+    tests_dir = os.path.join(path, "tests")
+    os.makedirs(tests_dir, exist_ok=True)
+    for number in range(suites):
+        name = f"suite_{number:03d}"
+        with open(os.path.join(tests_dir, f"{name}.robot"), "w") as f:
+            if number < datadriver_suites:
+                f.write(f"*** Settings ***\nLibrary    DataDriver    file={name}.csv\nTest Template    Check Value\n\n"
+                        "*** Test Cases ***\nCheck ${value}    0\n\n"
+                        f"*** Keywords ***\nCheck Value\n    [Arguments]    ${{value}}\n    Log    ${{value}}\n    Sleep    {sleep}\n"
+                        "    Should Not Be Equal    ${value}    fail\n")
+                with open(os.path.join(tests_dir, f"{name}.csv"), "w") as csv:
+                    csv.write("*** Test Cases ***;${value};[Tags];[Documentation]\n")
+                    for test in range(tests):
+                        value = "fail" if rng.random() < fail_rate else str(test)
+                        csv.write(f"Data {test};{value};;\n")
+                continue
+            f.write("*** Test Cases ***\n")
+            for test in range(tests):
+                status = "Fail    synthetic failure" if rng.random() < fail_rate else "No Operation"
+                f.write(f"Test {test:03d}\n    Log    {number} {test}\n    Sleep    {sleep}\n    {status}\n")
+
+
+class LocalContext:
+    """Stands in for the Lambda context, the executor asks it for the remaining time"""
+
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def count_request(model, **kwargs):
+    _requests[f"{model.service_model.service_name}.{model.name}"] += 1
+
+
+def init_worker(function, merger_queue, cache_root, latency_ms):
+    """Load the lambda_handler of a function into a worker process"""
+    global _handler
+    # Robot Framework writes its console output to the file descriptor, only the handler output is captured
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    sys.path[:0] = [os.path.join(REPO_ROOT, function), os.path.join(REPO_ROOT, "shared")]
+    import botocore.handlers
+    # every botocore session registers the built-in handlers, also the sessions the functions create themselves
+    botocore.handlers.BUILTIN_HANDLERS.append(("before-call", count_request))
+    if latency_ms:
+        botocore.handlers.BUILTIN_HANDLERS.append(("before-send", lambda **kwargs: time.sleep(latency_ms / 1000)))
+    app = importlib.import_module("app")
+    if function == "executor":
+        import project_cache
+        # every process is one Lambda container with its own /tmp
+        project_cache.CACHE_ROOT = os.path.join(cache_root, str(os.getpid()))
+        # stands in for the asynchronous invocation of the merger function
+        app.invoke_merger = lambda payload: merger_queue.put(json.loads(json.dumps(payload)))
+    _handler = app.lambda_handler
+
+
+def invoke(event, timeout):
+    """Invoke the handler of the worker, returns its response, the time, the EMF lines, the requests and the peak RSS"""
+    before = collections.Counter(_requests)
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        try:
+            response = _handler(event, LocalContext(timeout))
+        except Exception as err:
+            response = {"error": repr(err)}
+    elapsed = time.perf_counter() - start
+    emf = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"')]
+    return {
+        "response": response,
+        "elapsed": elapsed,
+        "emf": emf,
+        "requests": dict(collections.Counter(_requests) - before),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+class Report:
+    def __init__(self):
+        self.functions = collections.defaultdict(lambda: {
+            "invocations": 0, "errors": 0, "seconds": 0.0, "peak_rss_mb": 0.0,
+            "phases": collections.Counter(), "counters": collections.Counter()})
+        self.requests = collections.Counter()
+
+    def add(self, function, result):
+        stats = self.functions[function]
+        stats["invocations"] += 1
+        stats["errors"] += int("error" in result["response"])
+        stats["seconds"] += result["elapsed"]
+        stats["peak_rss_mb"] = max(stats["peak_rss_mb"], result["peak_rss_mb"])
+        for document in result["emf"]:
+            for definition in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]:
+                name = definition["Name"]
+                if definition["Unit"] == "Milliseconds":
+                    stats["phases"][name[:-len("Time")]] += document[name] / 1000
+                elif name != "ColdStart":
+                    stats["counters"][name] += document[name]
+                else:
+                    stats["counters"]["ColdStarts"] += document[name]
+        self.requests.update(result["requests"])
+        if "error" in result["response"]:
+            print(f"{function} failed: {result['response']['error']}", file=sys.stderr)
+
+    def to_dict(self, wall_time, arguments):
+        return {
+            "arguments": arguments,
+            "wall_seconds": round(wall_time, 3),
+            "functions": {name: {**stats, "seconds": round(stats["seconds"], 3),
+                                 "phases": {phase: round(seconds, 3) for phase, seconds in sorted(stats["phases"].items())},
+                                 "counters": dict(sorted(stats["counters"].items()))}
+                          for name, stats in self.functions.items()},
+            "requests": dict(sorted(self.requests.items())),
+        }
+
+    def print(self, wall_time):
+        print(f"end-to-end: {wall_time:.2f}s\n")
+        print(f"{'function':<12} {'invocations':>11} {'errors':>7} {'seconds':>9} {'peak RSS MB':>12}")
+        for name, stats in self.functions.items():
+            print(f"{name:<12} {stats['invocations']:>11} {stats['errors']:>7} {stats['seconds']:>9.2f} {stats['peak_rss_mb']:>12.1f}")
+        print(f"\n{'function':<12} {'phase':<20} {'seconds':>9}")
+        for name, stats in self.functions.items():
+            for phase, seconds in sorted(stats["phases"].items(), key=lambda item: -item[1]):
+                print(f"{name:<12} {phase:<20} {seconds:>9.2f}")
+        print(f"\n{'function':<12} {'counter':<20} {'value':>12}")
+        for name, stats in self.functions.items():
+            for counter, value in sorted(stats["counters"].items()):
+                print(f"{name:<12} {counter:<20} {value:>12}")
+        print(f"\n{'request':<40} {'count':>7}")
+        for request, number in sorted(self.requests.items(), key=lambda item: -item[1]):
+            print(f"{request:<40} {number:>7}")
+
+
+def create_resources(tests_dir):
+    import boto3
+    s3 = boto3.client("s3")
+    for bucket in ("tests", "results"):
+        s3.create_bucket(Bucket=bucket)
+    for root, _, files in os.walk(tests_dir):
+        for filename in files:
+            local_path = os.path.join(root, filename)
+            s3.upload_file(local_path, "tests", f"{PROJECT}/{os.path.relpath(local_path, tests_dir)}")
+    dynamodb = boto3.client("dynamodb")
+    dynamodb.create_table(
+        TableName="TestRunTable", BillingMode="PAY_PER_REQUEST",
+        AttributeDefinitions=[{"AttributeName": "run_id", "AttributeType": "S"}, {"AttributeName": "job_id", "AttributeType": "S"}],
+        KeySchema=[{"AttributeName": "run_id", "KeyType": "HASH"}, {"AttributeName": "job_id", "KeyType": "RANGE"}])
+    dynamodb.create_table(
+        TableName="TestShardTable", BillingMode="PAY_PER_REQUEST",
+        AttributeDefinitions=[{"AttributeName": "job_id", "AttributeType": "S"}],
+        KeySchema=[{"AttributeName": "job_id", "KeyType": "HASH"}])
+    sqs = boto3.client("sqs")
+    os.environ["WorkUnitQueueName"] = sqs.create_queue(QueueName="WorkUnitQueue", Attributes={"VisibilityTimeout": "300"})["QueueUrl"]
+    return sqs.create_queue(QueueName="TestJobQueue", Attributes={"VisibilityTimeout": "600"})["QueueUrl"]
+
+
+def is_final_merge(result):
+    body = result["response"].get("body")
+    return result["response"].get("statusCode") == 200 and isinstance(body, str) and '"tests_total"' in body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", type=int, default=10)
+    parser.add_argument("--tests", type=int, default=20, help="tests per suite")
+    parser.add_argument("--datadriver-suites", type=int, default=2)
+    parser.add_argument("--sleep", default="0s", help="Sleep of every test, e.g. 50ms")
+    parser.add_argument("--fail-rate", type=float, default=0.05)
+    parser.add_argument("--shards", type=int, default=8, help="shards, or workers with --dispatch pull")
+    parser.add_argument("--dispatch", choices=["push", "pull"], default="push")
+    parser.add_argument("--unit-size", type=int, default=5, help="tests per work unit with --dispatch pull")
+    parser.add_argument("--executors", type=int, default=4, help="concurrent executor containers")
+    parser.add_argument("--mergers", type=int, default=2, help="concurrent merger containers")
+    parser.add_argument("--batch-size", type=int, default=5, help="BatchSize of the SQS event source")
+    parser.add_argument("--merge-group-size", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds until the run is given up")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    import multiprocessing
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    os.environ.update({
+        "AWS_ENDPOINT_URL": f"http://{host}:{port}",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "TestsBucketName": "tests",
+        "ResultsBucketName": "results",
+        "TestRunTableName": "TestRunTable",
+        "TestShardTableName": "TestShardTable",
+        "MergerFunctionName": "merger",
+        "MergeGroupSize": str(args.merge_group_size),
+    })
+    generate_project(os.path.join(workdir, "project"), args.suites, args.tests, args.datadriver_suites,
+                     args.sleep, args.fail_rate, args.seed)
+    queue_url = create_resources(os.path.join(workdir, "project"))
+    os.environ["TestJobQueueName"] = queue_url
+
+    import boto3
+    sqs = boto3.client("sqs")
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    merger_queue = manager.Queue()
+    cache_root = os.path.join(workdir, "containers")
+    pools = {
+        function: context.Pool(processes, initializer=init_worker,
+                               initargs=(function, merger_queue, cache_root, args.latency_ms))
+        for function, processes in (("distributor", 1), ("executor", args.executors), ("merger", args.mergers))
+    }
+    report = Report()
+    run_id = str(uuid.uuid4())
+    try:
+        start = time.perf_counter()
+        request = {"project": PROJECT, "tests": "tests/", "shards": args.shards, "run_id": run_id,
+                   "dispatch": args.dispatch, "unit_size": args.unit_size}
+        result = pools["distributor"].apply(invoke, ({"body": json.dumps(request)}, 900))
+        report.add("distributor", result)
+        if result["response"].get("statusCode") != 200:
+            raise RuntimeError(f"Distributor failed: {result['response']}")
+
+        def complete_batch(messages, pending):
+            """Report an executor invocation and acknowledge its messages like the SQS event source"""
+            result = pending.get()
+            report.add("executor", result)
+            failed = {failure["itemIdentifier"] for failure in result["response"].get("batchItemFailures", [])}
+            if "error" in result["response"]:
+                failed = {message["MessageId"] for message in messages}
+            for message in messages:
+                if message["MessageId"] in failed:
+                    sqs.change_message_visibility(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"], VisibilityTimeout=0)
+                else:
+                    sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
+
+        executors, mergers, merged = [], [], False
+        while not merged:
+            if time.perf_counter() - start > args.timeout:
+                raise RuntimeError(f"Run {run_id} not merged after {args.timeout} seconds")
+            # the SQS event source: one batch per idle executor container
+            while len(executors) < args.executors:
+                messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=args.batch_size).get("Messages", [])
+                if not messages:
+                    break
+                event = {"Records": [{"messageId": message["MessageId"], "receiptHandle": message["ReceiptHandle"],
+                                      "body": message["Body"], "eventSource": "aws:sqs"} for message in messages]}
+                executors.append((messages, pools["executor"].apply_async(invoke, (event, 300))))
+            for messages, pending in [item for item in executors if item[1].ready()]:
+                executors.remove((messages, pending))
+                complete_batch(messages, pending)
+            # the asynchronous invocations of the merger
+            while not merger_queue.empty():
+                mergers.append(pools["merger"].apply_async(invoke, (merger_queue.get(), 60)))
+            for pending in [pending for pending in mergers if pending.ready()]:
+                mergers.remove(pending)
+                result = pending.get()
+                report.add("merger", result)
+                merged = merged or is_final_merge(result)
+            time.sleep(0.01)
+        # the executor which completes the run invokes the merger before it returns, its invocation is still pending
+        for messages, pending in executors:
+            complete_batch(messages, pending)
+        wall_time = time.perf_counter() - start
+
+        status = {"httpMethod": "GET", "queryStringParameters": {"project": PROJECT, "run_id": run_id}, "body": None}
+        report.add("status", pools["merger"].apply(invoke, (status, 60)))
+    finally:
+        for pool in pools.values():
+            pool.terminate()
+        manager.shutdown()
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report.print(wall_time)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report.to_dict(wall_time, vars(args)), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
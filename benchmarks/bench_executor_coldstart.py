@@ -0,0 +1,120 @@
+"""
+Benchmark the cold and warm start of the executor
+
+- init: imports executor/app.py in a fresh python process with -X importtime,
+  like the init phase of a new Lambda container, and reports the import time by package
+- cold/warm invocation: invokes the handler with an empty batch twice in the same process,
+  the first invocation of a container and a warm one
+- modules: imports every module of --modules alone in a fresh process, e.g. the modules
+  the executor only imports when a code path needs them (allure_robotframework, DataDriver, Browser)
+
+No AWS request is sent. Every measurement is repeated --repeat times, the median is reported.
+
+Requires the dependencies of the executor (robotframework, allure-robotframework, boto3).
+
+Usage:
+    python benchmarks/bench_executor_coldstart.py [--repeat 5] [--top 15] [--modules robot allure_robotframework DataDriver Browser boto3]
+"""
+import argparse
+import collections
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, sys, time
+sys.path[:0] = {paths!r}
+start = time.perf_counter()
+import app
+init = time.perf_counter() - start
+timings = []
+for _ in range(2):
+    start = time.perf_counter()
+    app.lambda_handler({{'Records': []}}, None)
+    timings.append(time.perf_counter() - start)
+print(json.dumps({{'init': init, 'cold': timings[0], 'warm': timings[1]}}))
+"""
+
+
+def environment():
+    return {
+        **os.environ,
+        "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+        "AWS_ACCESS_KEY_ID": os.environ.get("AWS_ACCESS_KEY_ID", "testing"),
+        "AWS_SECRET_ACCESS_KEY": os.environ.get("AWS_SECRET_ACCESS_KEY", "testing"),
+        "TestRunTableName": "TestRunTable",
+        "TestsBucketName": "tests",
+        "ResultsBucketName": "results",
+        "MergerFunctionName": "merger",
+    }
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of -X importtime
+    Returns:
+        the self time of all imports summed up by top level package
+        and the cumulative time of every top level import, both in seconds
+    """
+    packages, top_level = collections.Counter(), {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        packages[name.strip().split(".")[0]] += int(own) / 1_000_000
+        # nested imports are indented by two more spaces per level
+        if not name.startswith("  "):
+            top_level[name.strip()] = int(cumulative) / 1_000_000
+    return packages, top_level
+
+
+def run_child(code):
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                               env=environment(), cwd=os.path.join(REPO_ROOT, "executor"))
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    return completed.stdout, completed.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--modules", nargs="+", default=["robot", "allure_robotframework", "DataDriver", "Browser", "boto3"])
+    args = parser.parse_args()
+
+    paths = [os.path.join(REPO_ROOT, "executor"), os.path.join(REPO_ROOT, "shared")]
+    runs, packages = [], collections.defaultdict(list)
+    for _ in range(args.repeat):
+        stdout, stderr = run_child(CHILD.format(paths=paths))
+        runs.append(json.loads(stdout.strip().splitlines()[-1]))
+        for package, seconds in parse_importtime(stderr)[0].items():
+            packages[package].append(seconds)
+
+    print(f"{'phase':<18} {'median ms':>10}")
+    for phase in ("init", "cold", "warm"):
+        print(f"{phase:<18} {statistics.median(run[phase] for run in runs) * 1000:>10.1f}")
+
+    print(f"\n{'init imports by package':<30} {'median ms':>10}")
+    medians = {package: statistics.median(values + [0] * (args.repeat - len(values))) for package, values in packages.items()}
+    for package, seconds in sorted(medians.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{package:<30} {seconds * 1000:>10.1f}")
+
+    print(f"\n{'module alone':<30} {'median ms':>10}")
+    for module in args.modules:
+        try:
+            timings = []
+            for _ in range(args.repeat):
+                _, stderr = run_child(f"import {module}")
+                timings.append(parse_importtime(stderr)[1].get(module, 0))
+            print(f"{module:<30} {statistics.median(timings) * 1000:>10.1f}")
+        except RuntimeError as err:
+            print(f"{module:<30} {'failed':>10}: {err}")
+
+
+if __name__ == "__main__":
+    main()
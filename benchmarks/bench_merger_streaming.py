@@ -0,0 +1,122 @@
+"""
+Benchmark the merge of shard outputs in the merger
+
+Generates synthetic shard outputs (Robot Framework 7 output.xml format) with nested keywords
+and log messages and merges 10/100/1,000 of them:
+
+- rebot: rebot --merge, like the merger without MergeMode=streaming
+- streaming: merger/streaming.py, keeping --keyword-depth keyword levels
+
+Every merge runs in its own process, the reported peak RSS is the maximum resident set size of that process.
+
+Requires robotframework for the rebot mode, the streaming mode only needs the standard library.
+
+Usage:
+    python benchmarks/bench_merger_streaming.py [--shards 10 100 1000] [--tests 20] [--keyword-depth 1]
+"""
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "merger"))
+
+
+def keyword(out, depth, levels, messages):
+    out.write(f'<kw name="Level {depth} Keyword" owner="Resources">\n')
+    for number in range(messages):
+        out.write(f'<msg time="2024-01-01T12:00:00.000000" level="INFO">{escape(f"Message {number} " + "x" * 80)}</msg>\n')
+    if depth < levels:
+        for _ in range(2):
+            keyword(out, depth + 1, levels, messages)
+    out.write('<arg>${value}</arg>\n<status status="PASS" start="2024-01-01T12:00:00.000000" elapsed="0.010000"/>\n</kw>\n')
+
+
+def write_shard(path, shard, tests, levels, messages):
+    start = datetime.datetime(2024, 1, 1, 12) + datetime.timedelta(minutes=shard)
+    with open(path, 'w') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write('<robot generator="Robot 7.0 (Python 3.9.0 on linux)" generated="2024-01-01T12:00:00.000000" rpa="false" schemaversion="5">\n')
+        out.write('<suite id="s1" name="Tests" source="/tmp/project/tests">\n')
+        # 10 shards per suite, like the distributor splits a suite into several shards
+        out.write(f'<suite id="s1-s1" name="Suite {shard // 10}" source="/tmp/project/tests/suite_{shard // 10}.robot">\n')
+        for test in range(tests):
+            status = 'FAIL' if test % 7 == 0 else 'PASS'
+            out.write(f'<test id="s1-s1-t{test + 1}" name="Test {shard % 10}-{test}" line="{test + 1}">\n')
+            keyword(out, 1, levels, messages)
+            out.write(f'<tag>smoke</tag>\n<status status="{status}" start="{start.isoformat()}" elapsed="1.500000"/>\n</test>\n')
+        out.write(f'<status status="FAIL" start="{start.isoformat()}" elapsed="{tests * 1.5:.6f}"/>\n</suite>\n')
+        out.write(f'<status status="FAIL" start="{start.isoformat()}" elapsed="{tests * 1.5:.6f}"/>\n</suite>\n')
+        # the statistics section like Robot Framework writes it, its <suite> elements are not result suites
+        failed = len(range(0, tests, 7))
+        counts = f'pass="{tests - failed}" fail="{failed}" skip="0"'
+        out.write(f'<statistics>\n<total>\n<stat {counts}>All Tests</stat>\n</total>\n')
+        out.write(f'<tag>\n<stat {counts}>smoke</stat>\n</tag>\n<suite>\n')
+        out.write(f'<stat {counts} id="s1" name="Tests">Tests</stat>\n')
+        out.write(f'<stat {counts} id="s1-s1" name="Suite {shard // 10}">Tests.Suite {shard // 10}</stat>\n')
+        out.write('</suite>\n</statistics>\n<errors>\n</errors>\n</robot>\n')
+
+
+def merge(mode, inputs, output, keyword_depth):
+    """Runs in the child process"""
+    if mode == 'rebot':
+        from robot import rebot_cli
+        rebot_cli([f"--output={output}", "--log=NONE", "--report=NONE", "--merge", "--nostatusrc", *inputs], exit=False)
+    else:
+        from streaming import merge_outputs
+        merge_outputs(inputs, output, keyword_depth)
+
+
+def measure(mode, inputs, output, keyword_depth):
+    start = time.perf_counter()
+    command = [sys.executable, __file__, '--child', mode, '--output', output, '--keyword-depth', str(keyword_depth), *inputs]
+    child = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    stderr = child.stderr.read()
+    # wait4 reports the resource usage of this child only
+    _, status, usage = os.wait4(child.pid, 0)
+    child.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    if child.returncode != 0:
+        return None, None, stderr.strip().splitlines()[-1]
+    return elapsed, usage.ru_maxrss / 1024, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--tests", type=int, default=20, help="tests per shard")
+    parser.add_argument("--levels", type=int, default=3, help="keyword levels per test")
+    parser.add_argument("--messages", type=int, default=5, help="messages per keyword")
+    parser.add_argument("--keyword-depth", type=int, default=1)
+    parser.add_argument("--child", choices=['rebot', 'streaming'], help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    parser.add_argument("inputs", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        merge(args.child, args.inputs, args.output, args.keyword_depth)
+        return
+
+    print(f"{'shards':>7} {'input MB':>9} {'mode':>10} {'seconds':>8} {'peak RSS MB':>12} {'output MB':>10}")
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as workdir:
+            inputs = [os.path.join(workdir, f'{shard:05d}.xml') for shard in range(shards)]
+            for shard, path in enumerate(inputs):
+                write_shard(path, shard, args.tests, args.levels, args.messages)
+            input_mb = sum(os.path.getsize(path) for path in inputs) / 1024 / 1024
+            for mode in ('streaming', 'rebot'):
+                output = os.path.join(workdir, f'{mode}.xml')
+                elapsed, peak, error = measure(mode, inputs, output, args.keyword_depth)
+                if error:
+                    print(f"{shards:>7} {input_mb:>9.1f} {mode:>10} failed: {error}")
+                    continue
+                output_mb = os.path.getsize(output) / 1024 / 1024
+                print(f"{shards:>7} {input_mb:>9.1f} {mode:>10} {elapsed:>8.2f} {peak:>12.1f} {output_mb:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
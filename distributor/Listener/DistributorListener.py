@@ -1,26 +1,74 @@
-import numpy as np
-from pandas import DataFrame as df
-import pandas as pd
+import heapq
+import json
+import math
 import os
 import shutil
+import statistics
 from robot.running import Keyword
+import impact
+
+
+class TestRecord:
+    """A discovered test: the suite longname, the test name and if the suite uses DataDriver"""
+    __slots__ = ("suite", "test", "datadriver")
+
+    def __init__(self, suite, test, datadriver):
+        self.suite = suite
+        self.test = test
+        self.datadriver = datadriver
+
+    def to_dict(self):
+        return {"suite": self.suite, "test": self.test, "datadriver": self.datadriver}
+
+
+def split_evenly(items, sections):
+    """
+    Split items into the given number of consecutive sections of similar size,
+    the first sections get one item more if it does not divide evenly
+    (the same sizes as numpy.array_split)
+    """
+    size, extra = divmod(len(items), sections)
+    chunks = []
+    start = 0
+    for number in range(sections):
+        end = start + size + (1 if number < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
 
 class DistributorListener:
     ROBOT_LISTENER_API_VERSION = 3
 
-    def __init__(self, nodes=100, outputpath="distributor_output/"):
-        # create a new dataframe with columns suite (string) and test (string) and datadriver (boolean)
-
-        self.tests = df(columns=["suite", "test", "datadriver"])
-        # convert type of column datadriver to boolean
-        self.tests["datadriver"] = self.tests["datadriver"].astype(bool)
+    def __init__(self, nodes=100, outputpath="distributor_output/", timings=None, unit_size=None, select=None,
+                 project_root=None, split_on_close=True):
+        # list of TestRecord in the order of discovery
+        self.tests = []
         self.outputpath = outputpath
         # Create a new directory for the output files
         # If the directory already exists, delete it and create a new one
         if os.path.exists(self.outputpath):
             shutil.rmtree(self.outputpath)
-        os.mkdir(self.outputpath)
+        os.makedirs(self.outputpath)
         self.nodes = nodes
+        # historical test durations in seconds, keyed by "<suite longname>.<test name>"
+        self.timings = timings or {}
+        # with a unit size, the tests are split into chunks of about unit_size tests instead of nodes chunks
+        self.unit_size = unit_size
+        # "<suite longname>.<test name>" of the tests which are split into chunks, None splits all tests.
+        # The inventory always has all discovered tests.
+        self.select = select
+        # without split_on_close the caller splits the tests with write_chunks after the dry run,
+        # e.g. to select them by the dependency index of the dry run
+        self.split_on_close = split_on_close
+        # with a project folder, the sources and dependencies of the suites are added to the inventory, see impact.py
+        self.project_root = project_root
+        self.sources = {}
+        self.dependencies = {}
+        # the dependencies of the suites which are started, a suite inherits the ones of its parents
+        self.dependency_stack = []
+        # the dependencies of every resource file, parsed once per dry run
+        self.resources = {}
         self.uses_datadriver = False
         print("Distributor initialized")
 
@@ -29,6 +77,10 @@ class DistributorListener:
             self.uses_datadriver = True
         else:
             self.uses_datadriver = False
+        if self.project_root is not None:
+            # before the imports are removed below
+            inherited = self.dependency_stack[-1] if self.dependency_stack else set()
+            self.dependency_stack.append(inherited | impact.suite_dependencies(suite, self.project_root, self.resources))
         if suite.has_setup:
             suite.setup = Keyword('No Operation')
         if suite.has_teardown:
@@ -50,19 +102,49 @@ class DistributorListener:
     def end_suite(self, suite, result):
         # If suite contains tests, append them to the list of dictionaries with suite name and testname
         if len(suite.tests) > 0:
+            # all records of a suite share one suite name string
+            suite_name = suite.longname
             for test in suite.tests:
-                self.tests = pd.concat(
-                    [
-                        self.tests,
-                        pd.DataFrame(
-                            [[suite.longname, test.name, self.uses_datadriver]],
-                            columns=["suite", "test", "datadriver"],
-                        ),
-                    ],
-                    ignore_index=True,
-                )
+                self.tests.append(TestRecord(suite_name, test.name, self.uses_datadriver))
+            if self.project_root is not None:
+                self.sources[suite_name] = impact.relative_path(suite.source, self.project_root)
+                self.dependencies[suite_name] = sorted(self.dependency_stack[-1])
+        if self.dependency_stack:
+            self.dependency_stack.pop()
+
+    def inventory(self):
+        """
+        Return the discovered tests as a compact, json serializable inventory
+        which can be fed back with load_inventory instead of running a dry run
+
+        Example:
+        {"suites": [{"name": "Tests.Suite 1", "datadriver": false, "tests": ["test 1", "test 2"],
+                     "source": "tests/suite_1.robot", "dependencies": ["resources/common.resource"]}]}
+        """
+        suites = {}
+        for record in self.tests:
+            if record.suite not in suites:
+                suites[record.suite] = {"name": record.suite, "datadriver": record.datadriver, "tests": []}
+                if record.suite in self.dependencies:
+                    suites[record.suite]["source"] = self.sources[record.suite]
+                    suites[record.suite]["dependencies"] = self.dependencies[record.suite]
+            suites[record.suite]["tests"].append(record.test)
+        return {"suites": list(suites.values())}
+
+    def load_inventory(self, inventory):
+        for suite in inventory["suites"]:
+            if "dependencies" in suite:
+                self.sources[suite["name"]] = suite["source"]
+                self.dependencies[suite["name"]] = suite["dependencies"]
+            for test in suite["tests"]:
+                self.tests.append(TestRecord(suite["name"], test, suite["datadriver"]))
 
     def close(self):
+        # Robot Framework only logs the errors of listeners, a caller which has to see them calls write_chunks itself
+        if self.split_on_close:
+            self.write_chunks()
+
+    def write_chunks(self):
         """
         Split the self.tests into n number of chunks (where n is self.nodes)
         and create at least one chunk for each suite
@@ -120,31 +202,115 @@ class DistributorListener:
         chunk 4:
         suite: suite 2, test: test 1
         suite: suite 2, test: test 2
+
+        If historical timings are known for any of the tests, the chunks are
+        balanced by expected duration instead, see write_duration_chunks.
+
+        With select, only the selected tests are split, e.g. the failed tests of a rerun.
+        With a unit_size, the number of chunks is the number of tests divided by unit_size,
+        e.g. the small work units of the pull dispatch of the distributor.
         """
-        # group the self.tests per suite
-        grouped_tests = self.tests.groupby("suite")
-        # calculate percentage for each group of tests
-        grouped_tests_percentage = grouped_tests.size() / len(self.tests)
-        # calculate number of nodes for each group of tests (where n is self.nodes) rounded, but at least 1
-        grouped_tests_nodes = grouped_tests_percentage * self.nodes
-        grouped_tests_nodes = grouped_tests_nodes.apply(lambda x: max(1, round(x)))
-        print(grouped_tests_nodes)
-        # create n chunks for each group of tests, where n is the grouped_tests_nodes for that group
-        grouped_tests_chunks = grouped_tests.apply(
-            lambda x: np.array_split(x, grouped_tests_nodes[x.name])
-        )
-        # print the number of chunks for each group of tests
-        # print the number of tests in each chunk for each group of tests
-        for suite, chunks in grouped_tests_chunks.items():
+        selected = self.selected_tests()
+        if self.unit_size:
+            self.nodes = max(1, math.ceil(len(selected) / self.unit_size))
+        if any(self.timing_key(record.suite, record.test) in self.timings for record in selected):
+            self.write_duration_chunks(selected)
+            return
+        # group the selected tests per suite, sorted by suite name
+        grouped_tests = {}
+        for record in selected:
+            grouped_tests.setdefault(record.suite, []).append(record)
+        for suite in sorted(grouped_tests):
+            tests = grouped_tests[suite]
+            # calculate number of nodes for this group of tests (where n is self.nodes) rounded,
+            # but at least 1 and never more than the group has tests
+            nodes = min(len(tests), max(1, round(len(tests) / len(selected) * self.nodes)))
             print(suite)
-            chunk_number = 0
-            for chunk in chunks:
+            print(nodes)
+            for chunk_number, chunk in enumerate(split_evenly(tests, nodes), start=1):
                 print(len(chunk))
-                print(chunk.to_dict("records"))
-                # Generate incremental number for each chunk
-                # Create a new .json file with the incremental number
-                # Write the chunk to the file
-                chunk_number += 1
-                filename = "distributor_" + suite.replace(" ", "_") + "_" + "{:03d}".format(chunk_number) + ".json"
-                chunk.to_json(self.outputpath + filename, orient="records")
+                self.write_chunk(suite, chunk_number, chunk)
+
+    def selected_tests(self):
+        if self.select is None:
+            return self.tests
+        return [record for record in self.tests if self.timing_key(record.suite, record.test) in self.select]
+
+    def write_chunk(self, suite, chunk_number, chunk):
+        # Create a new .json file with the incremental number and write the chunk to the file
+        filename = "distributor_" + suite.replace(" ", "_") + "_" + "{:03d}".format(chunk_number) + ".json"
+        with open(self.outputpath + filename, "w") as f:
+            json.dump([record.to_dict() for record in chunk], f)
 
+    @staticmethod
+    def timing_key(suite, test):
+        return f"{suite}.{test}"
+
+    def write_duration_chunks(self, tests):
+        """
+        Split the tests into chunks of similar expected duration
+
+        Tests are still never mixed across suites, because the executor runs
+        every chunk with the suite of its first test.
+
+        1. Every test gets its duration from self.timings, tests that were
+           never seen get the median of all known durations
+        2. Every suite gets one chunk, then the remaining chunks are handed out
+           one by one to the suite with the longest expected time per chunk
+           (a suite never gets more chunks than it has tests)
+        3. Inside each suite the tests are packed with the
+           longest-processing-time-first rule: the longest test goes into the
+           chunk which currently has the lowest expected duration
+
+        Example:
+        suite 1: test 1 (60s), test 2 (5s), test 3 (5s), test 4 (5s)
+        suite 2: test 1 (10s), test 2 (10s)
+        and self.nodes = 3
+
+        then the chunks will be:
+        chunk 1 (60s):
+        suite: suite 1, test: test 1
+        chunk 2 (15s):
+        suite: suite 1, test: test 2
+        suite: suite 1, test: test 3
+        suite: suite 1, test: test 4
+        chunk 3 (20s):
+        suite: suite 2, test: test 1
+        suite: suite 2, test: test 2
+        """
+        known = [
+            self.timings[self.timing_key(record.suite, record.test)]
+            for record in tests
+            if self.timing_key(record.suite, record.test) in self.timings
+        ]
+        default_duration = statistics.median(known)
+        suites = {}
+        for record in tests:
+            duration = self.timings.get(self.timing_key(record.suite, record.test), default_duration)
+            suites.setdefault(record.suite, []).append((duration, record))
+
+        # hand out the chunks, always to the suite with the longest expected time per chunk
+        suite_chunks = {suite: 1 for suite in suites}
+        suite_totals = {suite: sum(d for d, _ in tests) for suite, tests in suites.items()}
+        heap = [(-suite_totals[suite], suite) for suite in suites if len(suites[suite]) > 1]
+        heapq.heapify(heap)
+        for _ in range(self.nodes - len(suites)):
+            if not heap:
+                break
+            _, suite = heapq.heappop(heap)
+            suite_chunks[suite] += 1
+            if suite_chunks[suite] < len(suites[suite]):
+                heapq.heappush(heap, (-suite_totals[suite] / suite_chunks[suite], suite))
+
+        for suite in sorted(suites):
+            # longest processing time first, ties keep the original test order
+            tests = sorted(enumerate(suites[suite]), key=lambda item: (-item[1][0], item[0]))
+            bins = [(0.0, number, []) for number in range(suite_chunks[suite])]
+            for _, (duration, record) in tests:
+                load, number, chunk = heapq.heappop(bins)
+                chunk.append(record)
+                heapq.heappush(bins, (load + duration, number, chunk))
+            print(suite)
+            for load, number, chunk in sorted(bins, key=lambda item: item[1]):
+                print(f"{len(chunk)} tests, expected duration {load:.1f}s")
+                self.write_chunk(suite, number + 1, chunk)
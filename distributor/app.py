@@ -1,18 +1,45 @@
 import json
 from robot import run
+from robot.api import ExecutionResult
 import uuid
 import boto3
 import datetime
+import collections
+import hashlib
+import time
 # import the DistributorListener class which is located in the Subfolder Listener/ in a file called DistributorListener.py
 from Listener.DistributorListener import DistributorListener
+import fanout
+import impact
+from rflambda.bundle import bundle_exists, upload_bundle
+from rflambda.metrics import annotate, instrument, phases, timed, timer
+from botocore.exceptions import ClientError
+from rflambda.runstate import (PROGRESS_RECORD, RUN_RECORD, cancel_run, get_record, group_record, is_job_item,
+                               query_run)
+from rflambda.transfer import download_s3_folder, list_objects, s3_client
 import os
 import shutil
+from decimal import Decimal
 
+# Bump when the format of the cached inventory or the way it is discovered changes
+DISCOVERY_CACHE_VERSION = 2
+# Number of shards the merger merges into one partial result as soon as all of them are executed
+MERGE_GROUP_SIZE = int(os.environ.get('MergeGroupSize', 20))
+# Pack the Allure results of every shard into one archive instead of uploading every file
+ALLURE_ARCHIVE = os.environ.get('AllureArchive', 'false').lower() == 'true'
+# push: every shard is one message of the TestJobQueue
+# pull: the shards are small work units in the WorkUnitQueue, the TestJobQueue gets one message per worker
+# and every worker claims units until the queue is empty, see pull_work_units in the executor
+DISPATCH_MODE = os.environ.get('DispatchMode', 'push')
+# Tests per work unit of the pull dispatch
+WORK_UNIT_SIZE = int(os.environ.get('WorkUnitSize', 5))
+# Runs with more shards have no status per shard in their progress record, it would exceed the item size limit
+MAX_PROGRESS_SHARDS = 2000
 
+
+@instrument('distributor')
 def lambda_handler(event, context):
     s3 = boto3.resource('s3')
-    dynamodb = boto3.resource('dynamodb')
-    sqs = boto3.client('sqs')
     # Get queue url from environment variable
     testjob_queue_url = os.environ['TestJobQueueName']
     testsbucket_name = os.environ['TestsBucketName']
@@ -21,12 +48,13 @@ def lambda_handler(event, context):
     testshardtable_name = os.environ['TestShardTableName']
     # generate filename like 2020-01-01T00:00:00.000Z.txt with current timestamp
     current_timestamp = datetime.datetime.utcnow().isoformat()
-    test_run_table = dynamodb.Table(testruntable_name)
-    test_shard_table = dynamodb.Table(testshardtable_name)
     if event["body"]:
         data=json.loads(event["body"])
     else:
         data=event
+    # {"action": "cancel", "run_id": ...} cancels a run which is executed
+    if data.get('action') == 'cancel':
+        return cancel(boto3.resource('dynamodb').Table(testruntable_name), data.get('run_id'))
     # Get event['project'], default to None
     project = data.get('project', None)
     # Get event['tests'], default to tests/
@@ -35,47 +63,177 @@ def lambda_handler(event, context):
     run_id = data.get('run_id', str(uuid.uuid4()))
     # Get event['shards'], default to None
     shards = int(data.get('shards', 1))
+    annotate(project=project, run_id=run_id)
+    # Get event['allure_archive'], default to the AllureArchive setting
+    allure_archive = bool(data.get('allure_archive', ALLURE_ARCHIVE))
+    # Get event['dispatch'], default to the DispatchMode setting, with pull dispatch event['shards'] is the number of workers
+    dispatch = data.get('dispatch', DISPATCH_MODE)
+    if dispatch not in ('push', 'pull'):
+        return {
+            'statusCode': 400,
+            'body': json.dumps('dispatch must be push or pull')
+        }
+    unit_size = int(data.get('unit_size', WORK_UNIT_SIZE)) if dispatch == 'pull' else None
+    # Get event['failure_threshold'], e.g. {"max_failures": 50, "max_failure_rate": 0.5, "min_tests": 20}, default to None
+    failure_threshold = {key: Decimal(str(value)) for key, value in (data.get('failure_threshold') or {}).items()
+                         if key in ('max_failures', 'max_failure_rate', 'min_tests')}
+    # Get event['rerun_failed'], the run_id of a merged run whose failed tests are executed again, default to None
+    rerun_of = data.get('rerun_failed', None)
+    failed_tests = None
+    if rerun_of and project:
+        test_run_table = boto3.resource('dynamodb').Table(testruntable_name)
+        previous_record = get_record(test_run_table, rerun_of, RUN_RECORD)
+        if previous_record is None or previous_record.get('run_status') != 'MERGED':
+            return {
+                'statusCode': 409,
+                'body': json.dumps(f'Test run {rerun_of} is not merged')
+            }
+        failed_tests = previous_failed_tests(test_run_table, resultsbucket_name, project, rerun_of, previous_record)
+        print(f"Rerunning {len(failed_tests)} failed tests of run {rerun_of}")
+        if not failed_tests:
+            return {
+                'statusCode': 200,
+                'body': json.dumps(f'Test run {rerun_of} has no failed tests')
+            }
     # if project and testsuite are not None, then download project folder from s3 bucket to tmp
     if project and tests:
-        print('Downloading project folder from s3 bucket to tmp')
         print(f"project: {project} testsuite: {tests}")
-        # Download project folder from s3 bucket to tmp
-        download_s3_folder(testsbucket_name, project, '/tmp/' + project)
-        # Create a dry run with no report, log, or output
-        dry_run = run(f'/tmp/{project}/{tests}', dryrun=True, listener=DistributorListener(shards, f'/tmp/{project}/distributor_output/'), output=None, log=None, report=None, runemptysuite=True, quiet=True)
-        for file in os.listdir(f'/tmp/{project}/distributor_output/'):
+        # Load the test durations of previous runs to balance the shards by duration
+        timings = load_test_timings(resultsbucket_name, project)
+        print(f"Found historical timings for {len(timings)} tests")
+        files = {}
+        content_version = project_content_hash(testsbucket_name, project, files)
+        # Get event['changed_paths'] or the changes since event['base_version'], a content version of the project, default to None
+        changes = changed_paths(resultsbucket_name, project, data, files)
+
+        def select(inventory):
+            """The tests which are split into shards: the failed tests of a rerun and the tests affected by the changes"""
+            selected = failed_tests
+            suites = impact.affected_suites(inventory, changes) if changes is not None else None
+            if suites is not None:
+                print(f"{len(suites)} of {len(inventory['suites'])} suites are affected by {len(changes)} changed paths")
+                affected = {f"{suite['name']}.{test}" for suite in inventory['suites'] if suite['name'] in suites
+                            for test in suite['tests']}
+                selected = affected if selected is None else selected & affected
+            return selected
+        # the tests are split after the dry run, so an error of the selection fails the request
+        listener = DistributorListener(shards, '/tmp/distributor_output/', timings, unit_size,
+                                       project_root=f'/tmp/{project}', split_on_close=False)
+        discovery_key = discovery_cache_key(content_version, tests)
+        inventory = None
+        if data.get('discovery_cache', True):
+            inventory = load_discovery_cache(resultsbucket_name, project, discovery_key)
+        if inventory is not None:
+            print(f"Discovery cache hit for {discovery_key}, skipping dry run")
+            listener.load_inventory(inventory)
+        else:
+            print(f"Discovery cache miss for {discovery_key}")
+            download_project(testsbucket_name, project)
+            # Create a dry run with no report, log, or output
+            with timer('DryRun'):
+                dry_run = run(f'/tmp/{project}/{tests}', dryrun=True, listener=listener, output=None, log=None, report=None, runemptysuite=True, quiet=True)
+            inventory = listener.inventory()
+            store_discovery_cache(resultsbucket_name, project, discovery_key, inventory)
+            # the files of this content version, later runs select the suites affected by the changes since it
+            store_version_files(resultsbucket_name, project, content_version, files)
+        listener.select = select(inventory)
+        listener.write_chunks()
+        # One archive of the project per content version, which every executor downloads with a single request
+        bundle = f'{project}/bundles/{content_version}.tar.gz'
+        with timer('Bundle'):
+            if not bundle_exists(resultsbucket_name, bundle):
+                if not os.path.exists(f'/tmp/{project}'):
+                    download_project(testsbucket_name, project)
+                size = upload_bundle(resultsbucket_name, bundle, f'/tmp/{project}')
+                print(f"Uploaded project bundle {bundle} ({size} bytes)")
+        shard_list = []
+        for file in sorted(os.listdir('/tmp/distributor_output/')):
             if file.endswith(".json"):
                 # read the json file
-                filename = file.split(".")[0]
-                with open(f'/tmp/{project}/distributor_output/{file}') as f:
-                    shard_data = json.load(f)
-                    job_id = str(uuid.uuid4())
-                    response = test_run_table.put_item(
-                                Item={'run_id': run_id, 'job_status': 'NOT STARTED', 'job_id': job_id, 'shards': shards})
-                    response = test_shard_table.put_item(
-                            Item={'run_id': run_id, 'shard_name': filename, 'shard_content': shard_data, 'job_id': job_id})
-                    message_body = json.dumps({'project': project, 'run_id': run_id, 'shard_name': filename, 'shard_content': shard_data, 'job_id': job_id, 'tests': tests})
-                    # Send message to sqs queue
-                    response = sqs.send_message(
-                        QueueUrl=testjob_queue_url,
-                        MessageBody=message_body,
-                        MessageAttributes={
-                            'project': {
-                                'DataType': 'String',
-                                'StringValue': project
-                            },
-                            'run_id': {
-                                'DataType': 'String',
-                                'StringValue': run_id
-                            },
-                            'job_id': {
-                                'DataType': 'String',
-                                'StringValue': job_id
-                            }
-                        }
-                    )
-        # Delete tmp folder
-        shutil.rmtree('/tmp', ignore_errors=True)
+                with open(f'/tmp/distributor_output/{file}') as f:
+                    shard_list.append({'shard_name': os.path.splitext(file)[0], 'shard_data': json.load(f),
+                                       'job_id': str(uuid.uuid4()), 'merge_group': len(shard_list) // MERGE_GROUP_SIZE})
+        if not shard_list:
+            shutil.rmtree(f'/tmp/{project}', ignore_errors=True)
+            shutil.rmtree('/tmp/distributor_output', ignore_errors=True)
+            return {
+                'statusCode': 200,
+                'body': json.dumps('No tests are selected, no test run is created')
+            }
+        # The executors count the executed shards in the run record and the merger folds the results
+        # of every group of shards as soon as the group is executed,
+        # the records must exist before the first executor finishes
+        groups = {}
+        for shard in shard_list:
+            groups.setdefault(shard['merge_group'], []).append(shard['job_id'])
+        items = [(testruntable_name, {'run_id': run_id, 'job_id': RUN_RECORD, 'run_status': 'NOT STARTED',
+                                      'total_shards': len(shard_list), 'completed_shards': 0,
+                                      'groups': len(groups), 'merged_groups': 0, 'allure_archive': allure_archive, 'dispatch': dispatch,
+                                      'tests_executed': 0, 'tests_passed': 0, 'tests_failed': 0, 'tests_skipped': 0,
+                                      'failure_threshold': failure_threshold, 'created_at': Decimal(str(round(time.time(), 3))),
+                                      # the base_version of later runs which select the tests affected by their changes
+                                      'content_version': content_version,
+                                      # the merger merges the results of a rerun over the merged output of this run
+                                      **({'rerun_of': rerun_of} if rerun_of else {}),
+                                      # for the metrics roll-up of the merger, the fan-out is not included
+                                      'distributor_phases': {phase: Decimal(str(seconds)) for phase, seconds in phases().items()}})]
+        for group, job_ids in groups.items():
+            items.append((testruntable_name, {'run_id': run_id, 'job_id': group_record(group), 'jobs': job_ids,
+                                              'total': len(job_ids), 'completed': 0}))
+        # The executors update the progress record of the run, the merger serves it without querying the jobs
+        track_shards = len(shard_list) <= MAX_PROGRESS_SHARDS
+        items.append((testruntable_name, {'run_id': run_id, 'job_id': PROGRESS_RECORD, 'run_status': 'NOT STARTED',
+                                          'updates': 0, 'failed_tests': [], 'first_failures': [],
+                                          # the executors update the fields of the entry of their shard
+                                          **({'shards': {str(number): {'status': 'NOT STARTED'} for number in range(len(shard_list))}}
+                                             if track_shards else {})}))
+        # The tests of every shard are stored once per run in a manifest, the messages only point to it,
+        # so their size does not depend on the number of tests in a shard
+        manifest = f'{project}/runs/{run_id}/shards.json'
+        store_shard_manifest(resultsbucket_name, manifest, inventory, shard_list)
+        messages = []
+        for number, shard in enumerate(shard_list):
+            filename = shard['shard_name']
+            job_id = shard['job_id']
+            items.append((testruntable_name, {'run_id': run_id, 'job_status': 'NOT STARTED', 'job_id': job_id, 'shards': shards}))
+            items.append((testshardtable_name, {'run_id': run_id, 'shard_name': filename, 'manifest': manifest, 'job_id': job_id}))
+            message_body = json.dumps({'project': project, 'run_id': run_id, 'shard_name': filename, 'manifest': manifest, 'job_id': job_id, 'tests': tests, 'bundle': bundle, 'content_version': content_version, 'merge_group': shard['merge_group'], 'allure_archive': allure_archive,
+                                       # the key of the shard in the progress record
+                                       'shard_number': number if track_shards else None})
+            messages.append({
+                'MessageBody': message_body,
+                'MessageAttributes': {
+                    'project': {
+                        'DataType': 'String',
+                        'StringValue': project
+                    },
+                    'run_id': {
+                        'DataType': 'String',
+                        'StringValue': run_id
+                    },
+                    'job_id': {
+                        'DataType': 'String',
+                        'StringValue': job_id
+                    }
+                }
+            })
+        # All items are written before the first message is sent, the executors expect them
+        dynamodb_client, sqs_client = fanout.clients()
+        with timer('FanoutDynamoDB'):
+            fanout.put_items(dynamodb_client, items)
+        with timer('FanoutSQS'):
+            if dispatch == 'pull':
+                # the units are queued before the workers, so no worker finds an empty queue
+                fanout.send_messages(sqs_client, os.environ['WorkUnitQueueName'], messages)
+                workers = worker_messages(project, run_id, min(shards, len(messages)))
+                fanout.send_messages(sqs_client, testjob_queue_url, workers)
+                print(f"Enqueued {len(messages)} work units and {len(workers)} workers of run {run_id}")
+            else:
+                fanout.send_messages(sqs_client, testjob_queue_url, messages)
+                print(f"Enqueued {len(messages)} shards of run {run_id}")
+        # Delete the project and the chunks, a warm container starts the next run without them
+        shutil.rmtree(f'/tmp/{project}', ignore_errors=True)
+        shutil.rmtree('/tmp/distributor_output', ignore_errors=True)
         return {
             'statusCode': 200,
             'body': json.dumps(f'Test run {run_id} created')
@@ -86,22 +244,219 @@ def lambda_handler(event, context):
             'body': json.dumps('project and testsuite are required')
         }
 
-def download_s3_folder(bucket_name, s3_folder, local_dir=None):
+@timed('FailedTests')
+def previous_failed_tests(table, bucket_name, project, run_id, run_record):
+    """
+    Return the failed tests of a merged run as "<suite longname>.<test name>"
+    They are read from the shard summaries in DynamoDB, or for a rerun from the statistics the merger stored
+    in its run record, if they list all failed tests, otherwise from the merged output of the run
+    """
+    failed_tests = set()
+    complete = True
+    if 'rerun_of' in run_record:
+        # the summaries of a rerun only have the tests which were executed again
+        merged_summary = run_record.get('merged_summary')
+        complete = merged_summary is not None and len(merged_summary['failed_tests']) >= int(merged_summary['failed'])
+        if complete:
+            failed_tests.update(merged_summary['failed_tests'])
+    else:
+        for item in filter(is_job_item, query_run(table, run_id)):
+            if item.get('job_status') == 'CANCELLED':
+                continue
+            # the summary of a shard lists at most 100 failed tests
+            if 'total' not in item or len(item.get('failed_tests', [])) < int(item['failed']):
+                complete = False
+                break
+            failed_tests.update(item.get('failed_tests', []))
+    if complete:
+        return failed_tests
+    output = '/tmp/distributor_previous_output.xml'
+    s3_client().download_file(bucket_name, f'{project}/results/{run_id}/final/output.xml', output)
+    try:
+        return {test.longname for test in ExecutionResult(output).suite.all_tests if test.status == 'FAIL'}
+    finally:
+        os.remove(output)
+
+
+def cancel(table, run_id):
+    """
+    Cancel a run: the executors drop its shards which are not started yet and stop the running ones,
+    the merger builds the report from the shards which were executed
     """
-    Download the contents of a folder directory
+    if not run_id:
+        return {
+            'statusCode': 400,
+            'body': json.dumps('run_id is required')
+        }
+    try:
+        cancel_run(table, run_id, 'cancelled by request')
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return {
+            'statusCode': 404,
+            'body': json.dumps(f'Test run {run_id} not found')
+        }
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Test run {run_id} cancelled')
+    }
+
+
+def worker_messages(project, run_id, workers):
+    """
+    The messages of the TestJobQueue for the pull dispatch, every message starts one worker
+    A worker is not bound to the run, it claims any unit of the WorkUnitQueue
+    """
+    return [{
+        'MessageBody': json.dumps({'dispatch': 'pull', 'project': project, 'run_id': run_id, 'worker': number}),
+        'MessageAttributes': {
+            'project': {
+                'DataType': 'String',
+                'StringValue': project
+            },
+            'run_id': {
+                'DataType': 'String',
+                'StringValue': run_id
+            }
+        }
+    } for number in range(workers)]
+
+
+@timed('LoadTimings')
+def load_test_timings(bucket_name, project):
+    """
+    Load the historical test durations of a project
+    The file is maintained by the merger after every merged run
     Args:
-        bucket_name: the name of the s3 bucket
-        s3_folder: the folder path in the s3 bucket
-        local_dir: a relative or absolute directory path in the local file system
+        bucket_name: the name of the s3 results bucket
+        project: the project folder in the s3 bucket
+    Returns:
+        dict of "<suite longname>.<test name>" to the duration in seconds,
+        empty if the project was never merged before
     """
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    for obj in bucket.objects.filter(Prefix=s3_folder):
-        target = obj.key if local_dir is None \
-            else os.path.join(local_dir, os.path.relpath(obj.key, s3_folder))
-        if not os.path.exists(os.path.dirname(target)):
-            os.makedirs(os.path.dirname(target))
-        if obj.key[-1] == '/':
-            continue
-        bucket.download_file(obj.key, target)
+    client = boto3.client('s3')
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=f'{project}/timings.json')
+    except client.exceptions.NoSuchKey:
+        return {}
+    history = json.loads(response['Body'].read())
+    # files written before the merger counted the runs are a flat dict of durations
+    return history['durations'] if 'runs' in history else history
+
+
+@timed('Download')
+def download_project(bucket_name, project):
+    print('Downloading project folder from s3 bucket to tmp')
+    objects, size = download_s3_folder(bucket_name, project, '/tmp/' + project)
+    print(f"Downloaded {objects} files ({size} bytes)")
+
+
+@timed('ContentHash')
+def project_content_hash(bucket_name, project, files=None):
+    """
+    Hash the content of a project folder without downloading it
+    The hash is built from the S3 listing: key, ETag and size of every object,
+    so any changed, added or removed file results in a new hash
+    Args:
+        bucket_name: the name of the s3 tests bucket
+        project: the project folder in the s3 bucket
+        files: a dict which is filled with the ETag of every file, by its path in the project folder
+    """
+    content_hash = hashlib.sha256()
+    # the listing is returned in key order, so the hash is stable
+    for obj in list_objects(bucket_name, project):
+        content_hash.update(f"{obj['Key']}\0{obj['ETag']}\0{obj['Size']}\n".encode())
+        if files is not None:
+            files[obj['Key'][len(project):].lstrip('/')] = obj['ETag']
+    return content_hash.hexdigest()
+
+
+def store_version_files(bucket_name, project, content_version, files):
+    s3_client().put_object(Bucket=bucket_name, Key=f'{project}/versions/{content_version}.json',
+                           Body=json.dumps(files, separators=(',', ':')))
+
+
+def changed_paths(bucket_name, project, data, files):
+    """
+    The changed paths of a request: event['changed_paths'], or the difference between the files
+    of the project and the ones of the content version event['base_version']
+    Returns:
+        the paths relative to the project folder, None to select all tests
+    """
+    if data.get('changed_paths') is not None:
+        return list(data['changed_paths'])
+    if not data.get('base_version'):
+        return None
+    try:
+        response = s3_client().get_object(Bucket=bucket_name, Key=f"{project}/versions/{data['base_version']}.json")
+    except s3_client().exceptions.NoSuchKey:
+        print(f"Content version {data['base_version']} is not known, selecting all tests")
+        return None
+    return impact.changed_paths(json.loads(response['Body'].read()), files)
+
+
+def discovery_cache_key(content_version, tests):
+    """
+    The discovered tests depend on the project content, the tests path inside of the project
+    and the way the distributor discovers them
+    """
+    return hashlib.sha256(f'{DISCOVERY_CACHE_VERSION}\0{content_version}\0{tests}'.encode()).hexdigest()
+
+
+@timed('Manifest')
+def store_shard_manifest(bucket_name, key, inventory, shard_list):
+    """
+    Store the tests of all shards of a run as indexes into the inventory
+    Args:
+        bucket_name: the name of the s3 results bucket
+        key: the key of the manifest
+        inventory: the inventory of the discovered tests, see DistributorListener.inventory
+        shard_list: the shards, each with the shard_name and the shard_data
+
+    Example:
+    {"inventory": {"suites": [{"name": "Tests.Suite 1", "datadriver": false, "tests": ["test 1", "test 2"]}]},
+     "shards": {"distributor_Tests.Suite_1_001": {"suite": 0, "tests": [0, 1]}}}
+    """
+    suite_indexes = {suite['name']: index for index, suite in enumerate(inventory['suites'])}
+    # DataDriver can create several tests with the same name in a suite, each of them gets its own index
+    test_indexes = []
+    for suite in inventory['suites']:
+        indexes = {}
+        for index, test in enumerate(suite['tests']):
+            indexes.setdefault(test, collections.deque()).append(index)
+        test_indexes.append(indexes)
+    shards = {}
+    for shard in shard_list:
+        # every shard holds tests of a single suite
+        suite_index = suite_indexes[shard['shard_data'][0]['suite']]
+        shards[shard['shard_name']] = {
+            'suite': suite_index,
+            'tests': [test_indexes[suite_index][test['test']].popleft() for test in shard['shard_data']],
+        }
+    # the executors only need the tests of the inventory, not its dependency index
+    tests = {'suites': [{key: suite[key] for key in ('name', 'datadriver', 'tests')} for suite in inventory['suites']]}
+    s3_client().put_object(Bucket=bucket_name, Key=key,
+                           Body=json.dumps({'inventory': tests, 'shards': shards}, separators=(',', ':')))
+
+
+@timed('DiscoveryCache')
+def load_discovery_cache(bucket_name, project, discovery_key):
+    """
+    Load the inventory of a previous dry run of the same project content
+    Returns:
+        the inventory, None if the content was never discovered before
+    """
+    client = boto3.client('s3')
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=f'{project}/discovery/{discovery_key}.json')
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
+
 
+@timed('DiscoveryCache')
+def store_discovery_cache(bucket_name, project, discovery_key, inventory):
+    client = boto3.client('s3')
+    client.put_object(Bucket=bucket_name, Key=f'{project}/discovery/{discovery_key}.json',
+                      Body=json.dumps(inventory, separators=(',', ':')))
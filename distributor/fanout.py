@@ -0,0 +1,104 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from rflambda.metrics import count
+
+# Number of parallel DynamoDB and SQS requests of the fan-out
+FANOUT_CONCURRENCY = int(os.environ.get('FanoutConcurrency', 16))
+# Limits of batch_write_item and send_message_batch
+DYNAMODB_BATCH_SIZE = 25
+SQS_BATCH_SIZE = 10
+SQS_BATCH_BYTES = 256 * 1024
+MAX_ATTEMPTS = 8
+
+_serializer = TypeSerializer()
+
+
+def clients(concurrency=FANOUT_CONCURRENCY):
+    """Low level clients are thread safe, unlike boto3 resources"""
+    config = Config(max_pool_connections=concurrency, retries={'max_attempts': 10, 'mode': 'adaptive'})
+    return boto3.client('dynamodb', config=config), boto3.client('sqs', config=config)
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def backoff(attempt):
+    time.sleep(min(2, 0.05 * 2 ** attempt))
+
+
+def put_items(dynamodb_client, items, concurrency=FANOUT_CONCURRENCY):
+    """
+    Write items with batch_write_item, 25 items per request and concurrency requests in parallel
+    Unprocessed items are retried with exponential backoff
+    Args:
+        dynamodb_client: a low level DynamoDB client
+        items: list of (table name, item) tuples, the items with python types like for Table.put_item
+    """
+    requests = [(table_name, {'PutRequest': {'Item': {key: _serializer.serialize(value) for key, value in item.items()}}})
+                for table_name, item in items]
+
+    def write(batch):
+        request_items = {}
+        for table_name, request in batch:
+            request_items.setdefault(table_name, []).append(request)
+        for attempt in range(MAX_ATTEMPTS):
+            request_items = dynamodb_client.batch_write_item(RequestItems=request_items).get('UnprocessedItems')
+            if not request_items:
+                return
+            backoff(attempt)
+        raise RuntimeError(f"Couldn't write {sum(len(r) for r in request_items.values())} items after {MAX_ATTEMPTS} attempts")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # list() re-raises the first failed batch
+        list(pool.map(write, chunks(requests, DYNAMODB_BATCH_SIZE)))
+    count('DynamoDBItems', len(requests))
+
+
+def message_batches(messages):
+    """Group messages into batches of at most 10 messages and 256 KB"""
+    batch, batch_bytes = [], 0
+    for message in messages:
+        size = len(message['MessageBody'].encode()) + len(json.dumps(message.get('MessageAttributes', {})))
+        if batch and (len(batch) == SQS_BATCH_SIZE or batch_bytes + size > SQS_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(message)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def send_messages(sqs_client, queue_url, messages, concurrency=FANOUT_CONCURRENCY):
+    """
+    Send messages with send_message_batch, concurrency requests in parallel
+    Failed entries are retried with exponential backoff, unless SQS reports them as the sender's fault
+    Args:
+        sqs_client: an SQS client
+        queue_url: the url of the queue
+        messages: list of dicts with MessageBody and MessageAttributes like for send_message
+    """
+    def send(batch):
+        entries = {str(number): message for number, message in enumerate(batch)}
+        for attempt in range(MAX_ATTEMPTS):
+            response = sqs_client.send_message_batch(
+                QueueUrl=queue_url, Entries=[{'Id': number, **message} for number, message in entries.items()])
+            failed = response.get('Failed', [])
+            if not failed:
+                return
+            sender_faults = [entry for entry in failed if entry.get('SenderFault')]
+            if sender_faults:
+                raise RuntimeError(f"SQS rejected messages: {sender_faults}")
+            entries = {entry['Id']: entries[entry['Id']] for entry in failed}
+            backoff(attempt)
+        raise RuntimeError(f"Couldn't send {len(entries)} messages after {MAX_ATTEMPTS} attempts")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, message_batches(messages)))
+    count('SQSMessages', len(messages))
@@ -0,0 +1,167 @@
+"""
+Change-impact selection: which suites are affected by changed files of a project
+
+The dependency index is built by the DistributorListener during the dry run, from the imports of every suite,
+and stored with the discovered tests in the discovery cache:
+
+    {"name": "Tests.Login", "source": "tests/login.robot",
+     "dependencies": ["resources/common.resource", "data/login.csv", "library:LoginLibrary"], ...}
+
+The dependencies of a suite are the files it imports (resource files, recursively, and variable files),
+the libraries it imports, the data file of DataDriver and the initialization files of its parent folders.
+Paths are relative to the project folder, libraries imported by name are stored as "library:<name>".
+"""
+import os
+import posixpath
+
+LIBRARY_PREFIX = 'library:'
+INIT_FILES = ('__init__.robot', '__init__.resource', '__init__.txt', '__init__.tsv', '__init__.rst')
+# Changed files with these extensions never change the result of a test
+IGNORED_EXTENSIONS = ('.md', '.rst', '.adoc', '.png', '.jpg', '.svg')
+
+
+def relative_path(path, root):
+    """The path relative to the project folder, None for paths outside of it"""
+    path = os.path.relpath(os.path.normpath(str(path)), root)
+    return None if path.startswith('..') else path.replace(os.sep, '/')
+
+
+def resolve_import(name, directory, root):
+    """
+    Resolve the name of an imported file like Robot Framework, relative to the folder of the importing file
+    ${CURDIR} is already replaced by the parser, names with other variables can not be resolved
+    Returns:
+        the path relative to the project folder, None if it can not be resolved
+    """
+    if '${' in name:
+        return None
+    return relative_path(os.path.join(directory or root, name), root)
+
+
+def is_path(name):
+    return name.endswith('.py') or '/' in name or os.sep in name
+
+
+def import_dependencies(imports, directory, root, resources):
+    """
+    The dependencies of a list of imports, resource files are followed recursively
+    Args:
+        imports: the imports of a suite or of a resource file
+        directory: the folder of the importing file
+        root: the project folder
+        resources: the dependencies of every resource file which was parsed already, by path
+    """
+    dependencies = set()
+    for item in imports:
+        kind = item.type.upper()
+        name = str(item.name)
+        if kind == 'LIBRARY' and not is_path(name):
+            dependencies.add(LIBRARY_PREFIX + name)
+            continue
+        path = resolve_import(name, getattr(item, 'directory', None) or directory, root)
+        if path is None:
+            continue
+        dependencies.add(path)
+        if kind == 'RESOURCE':
+            dependencies.update(resource_dependencies(path, root, resources))
+    return dependencies
+
+
+def resource_dependencies(path, root, resources):
+    """The dependencies of a resource file, every file is parsed once per dry run"""
+    if path not in resources:
+        # set before parsing, so resource files which import each other do not recurse forever
+        resources[path] = set()
+        source = os.path.join(root, path)
+        if os.path.isfile(source):
+            from robot.running.builder import ResourceFileBuilder
+            resource = ResourceFileBuilder().build(source)
+            resources[path] = import_dependencies(resource.imports, os.path.dirname(source), root, resources)
+    return resources[path]
+
+
+def datadriver_file(item, suite_source):
+    """
+    The data file of a DataDriver import: the file argument or, like DataDriver does by default,
+    the suite file with the extension .csv
+    """
+    for number, arg in enumerate(item.args):
+        arg = str(arg)
+        if arg.startswith('file='):
+            return arg[len('file='):]
+        if number == 0 and '=' not in arg:
+            return arg
+    return os.path.splitext(os.path.basename(str(suite_source)))[0] + '.csv'
+
+
+def suite_dependencies(suite, root, resources):
+    """
+    The dependencies of one suite, without the ones of its parent suites
+    Args:
+        suite: the running suite, before the DistributorListener removes its imports
+        root: the project folder
+        resources: the dependencies of the resource files parsed so far, see resource_dependencies
+    """
+    source = str(suite.source) if suite.source else None
+    if source is None:
+        return set()
+    directory = source if os.path.isdir(source) else os.path.dirname(source)
+    dependencies = import_dependencies(suite.resource.imports, directory, root, resources)
+    if os.path.isdir(source):
+        # the settings of a folder suite are in its initialization file
+        for init_file in INIT_FILES:
+            if os.path.isfile(os.path.join(source, init_file)):
+                dependencies.add(relative_path(os.path.join(source, init_file), root))
+    for item in suite.resource.imports:
+        if item.name == 'DataDriver':
+            path = resolve_import(datadriver_file(item, source), directory, root)
+            if path is not None:
+                dependencies.add(path)
+    return dependencies
+
+
+def changed_paths(base_files, files):
+    """
+    The paths which differ between two versions of a project
+    Args:
+        base_files, files: dicts of path to ETag, see project_content_hash in the distributor
+    """
+    return sorted(path for path in set(base_files) | set(files) if base_files.get(path) != files.get(path))
+
+
+def library_matches(path, dependencies):
+    """True if a changed python file is a library which is imported by name, e.g. libs/LoginLibrary.py"""
+    if not path.endswith('.py'):
+        return False
+    module = path[:-len('.py')]
+    if module.endswith('/__init__'):
+        module = module[:-len('/__init__')]
+    names = {LIBRARY_PREFIX + module.replace('/', '.'), LIBRARY_PREFIX + posixpath.basename(module)}
+    return any(dependency in names or (dependency.startswith(LIBRARY_PREFIX) and
+                                       module.replace('/', '.').endswith('.' + dependency[len(LIBRARY_PREFIX):]))
+               for dependency in dependencies)
+
+
+def affected_suites(inventory, paths):
+    """
+    Select the suites which are affected by changed paths
+    A changed path affects the suites it is the source or a dependency of.
+    If a changed path is not known to any suite, its impact is unknown and all suites are selected.
+    Args:
+        inventory: the inventory of the discovered tests with the dependency index
+        paths: the changed paths, relative to the project folder
+    Returns:
+        the names of the affected suites, None if all suites are affected
+    """
+    selected = set()
+    for path in paths:
+        path = posixpath.normpath(path.lstrip('/'))
+        matched = [suite['name'] for suite in inventory['suites']
+                   if path == suite.get('source') or path in suite.get('dependencies', ())
+                   or library_matches(path, suite.get('dependencies', ()))]
+        if matched:
+            selected.update(matched)
+        elif not path.lower().endswith(IGNORED_EXTENSIONS):
+            print(f"Changed path {path} is not a dependency of any suite, selecting all suites")
+            return None
+    return selected
@@ -1,27 +1,53 @@
 import json
 import uuid
-import boto3
 import datetime
 from robot import run
 from robot.api import ExecutionResult
 import shutil
 import os
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
 import logging
-from allure_robotframework import allure_robotframework
+import threading
+import time
+from decimal import Decimal
+from rflambda.bundle import extract_bundle, upload_bundle
+from rflambda.metrics import Metrics, count, instrument, phases, timed, timer
+from rflambda.runstate import (RUN_RECORD, cancel_run, claim, count_job, failure_threshold_exceeded, get_record,
+                               group_record, is_run_executed, release, update_progress)
+from rflambda.transfer import download_s3_folder, s3_client, upload_s3_folder
+import container
+from project_cache import get_project, release_project
+from parallel import EXECUTOR_WORKERS, merge_options, run_parallel, shard_options
 
 logger = logging.getLogger(__name__)
 
+# A shard is only started if the invocation has at least this much time left,
+# otherwise its message goes back to the queue
+MIN_REMAINING_TIME_FOR_SHARD = int(os.environ.get('MinRemainingTimeForShard', 60)) * 1000
+# Long polling of the WorkUnitQueue, a short poll may miss units which are in the queue
+WORK_UNIT_WAIT_SECONDS = 1
+# Only a job with one of these statuses is started, a message of a job which is done is dropped
+STARTABLE_JOB_STATUSES = ('NOT STARTED', 'IN_PROGRESS')
+# Failed tests listed in the summary of a shard, keeps the DynamoDB item small
+MAX_FAILED_TESTS = 100
+# Failed tests of a shard added to the progress record, while the run has less than MAX_PROGRESS_FAILURES failed tests
+MAX_PROGRESS_FAILURES_PER_SHARD = 5
+MAX_PROGRESS_FAILURES = 100
+# Shard manifests of the latest runs, kept for the lifetime of the container
+MAX_CACHED_MANIFESTS = 4
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+@instrument('executor')
 def lambda_handler(event, context):
-    """Sample pure Lambda function
+    """Execute a batch of shards sent by the distributor
 
     Parameters
     ----------
     event: dict, required
-        API Gateway Lambda Proxy Input Format
+        SQS Event, every record is one shard
 
-        Event doc: https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html#api-gateway-simple-proxy-for-lambda-input-format
+        Event doc: https://docs.aws.amazon.com/lambda/latest/dg/with-sqs.html
 
     context: object, required
         Lambda Context runtime methods and attributes
@@ -30,140 +56,383 @@ def lambda_handler(event, context):
 
     Returns
     ------
-    API Gateway Lambda Proxy Output Format: dict
+    SQS partial batch response: dict
 
-        Return doc: https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html
+        The messages of failed shards, only these are retried
+        Return doc: https://docs.aws.amazon.com/lambda/latest/dg/with-sqs.html#services-sqs-batchfailurereporting
     """
-    s3 = boto3.resource('s3')
-    dynamodb = boto3.resource('dynamodb')
-    testsbucket_name = os.environ['TestsBucketName']
-    resultsbucket_name = os.environ['ResultsBucketName']
     testruntable_name = os.environ['TestRunTableName']
-    testshardtable_name = os.environ['TestShardTableName']
-    # generate filename like 2020-01-01T00:00:00.000Z.txt with current timestamp
-    current_timestamp = datetime.datetime.utcnow().isoformat()
-    test_run_table = dynamodb.Table(testruntable_name)
-    test_shard_table = dynamodb.Table(testshardtable_name)
-    for record in event['Records']:
-        print("test")
+    records = event['Records']
+    count('Shards', len(records))
+    # With several workers, the shards of the batch run at the same time and share the worker processes
+    concurrent_shards = max(1, min(EXECUTOR_WORKERS, len(records)))
+    processes = max(1, EXECUTOR_WORKERS // concurrent_shards)
+    # the Playwright process pre-launched during the init phase, if any, must be up before the first test
+    container.ensure_playwright()
+    # the browser server of the container is shared by the shards, each of them creates its own contexts
+    with timer('BrowserServer'):
+        options = {'prerunmodifier': ['browser_reuse.ReuseBrowser']} if container.browser_endpoint() else {}
+
+    def run_shard(payload):
+        """Returns: True if the shard is executed"""
+        # every shard reports its own phases, the merger rolls them up per run
+        shard_metrics = Metrics('executor', run_id=payload.get('run_id'), job_id=payload.get('job_id'),
+                                shard_name=payload.get('shard_name'))
+        with shard_metrics.activate():
+            try:
+                # the table handles of a thread are reused by later invocations of the container
+                execute_shard(payload, container.table(testruntable_name), processes, options)
+            except Exception:
+                logger.exception("Couldn't execute shard %s of run %s", payload.get('job_id'), payload.get('run_id'))
+                shard_metrics.count('ShardFailures')
+                return False
+            finally:
+                shard_metrics.emit()
+        return True
+
+    def process_record(record):
+        if context is not None and context.get_remaining_time_in_millis() < MIN_REMAINING_TIME_FOR_SHARD:
+            print(f"Not enough time left for message {record['messageId']}, returning it to the queue")
+            return record, None, False
         payload = json.loads(record["body"])
-        run_id = payload.get("run_id", None)
-        job_id = payload.get("job_id", None)
-        project = payload.get('project', None)
-        tests = payload.get('tests', None)
-        shard_name = payload.get('shard_name', None)
-        shard_content = payload.get('shard_content', None)
-        download_s3_folder(testsbucket_name, project, '/tmp/' + project)
-        print(str(payload))
-        set_test_job_status(test_run_table, run_id, job_id, "IN_PROGRESS")
-        options_dict = {'outputdir': f'/tmp/{project}/results/{run_id}',  'report': None, 'log': None, 'output':f'{job_id}.xml', 'listener':allure_robotframework(f'/tmp/{project}/results/{run_id}/allure-results')}
-        if shard_content[0]["datadriver"]:
-            dynamictest_list = "|".join([test["suite"] + "." + test["test"] for test in shard_content])
-            dynamictest_arg = "DYNAMICTESTS:" + dynamictest_list
-            # filename without extension
-            
-            run(f'/tmp/{project}/{tests}', **options_dict,  variable=[dynamictest_arg], suite=[shard_content[0]["suite"]])
-        # if datadriver is False in the first test, run the test without datadriver
-        else:
-            # Create list of strings in test_list with format test["suite"].test["test"]
-            test_list = ["*"+test["suite"] + "." + test["test"] for test in shard_content]
-            run(f'/tmp/{project}/{tests}', **options_dict, test=test_list, suite=[shard_content[0]["suite"]])
-        #s3.Bucket(resultsbucket_name).upload_file(f'/tmp/{project}/results/{run_id}/{job_id}.xml', f'{project}/results/{run_id}/{job_id}.xml')
-        upload_folder_to_s3(resultsbucket_name, f'{project}/results/{run_id}', f'/tmp/{project}/results/{run_id}')
-    # Delete tmp folder
-    shutil.rmtree('/tmp', ignore_errors=True)
-    set_test_job_status(test_run_table, run_id, job_id, "EXECUTED")
-
-        # if run is not executed, return 202
-    if is_run_executed(test_run_table, run_id):
-        # Execute the merger lambda function
-        lambda_client = boto3.client('lambda')
-        lambda_client.invoke(FunctionName=os.environ['MergerFunctionName'], InvocationType='Event', Payload=json.dumps({"run_id": run_id, "project": project}))
+        if payload.get('dispatch') == 'pull':
+            return record, payload, pull_work_units(payload, run_shard, context)
+        return record, payload, run_shard(payload)
 
+    # SQS messages which are not processed successfully, they are retried without the rest of the batch
+    batch_item_failures = []
+    # a single shard at a time runs in the main thread, where Robot Framework can handle signals
+    results = map(process_record, records) if concurrent_shards == 1 else container.shard_pool().map(process_record, records)
+    for record, payload, executed in results:
+        # executed shards trigger the merger themselves, see complete_job
+        if not executed:
+            batch_item_failures.append({"itemIdentifier": record['messageId']})
+
+    count('BatchItemFailures', len(batch_item_failures))
     return {
-        "statusCode": 200
+        "batchItemFailures": batch_item_failures
     }
 
-def download_s3_folder(bucket_name, s3_folder, local_dir=None):
+
+def pull_work_units(worker, run_unit, context):
     """
-    Download the contents of a folder directory
+    Claim the work units of the WorkUnitQueue one by one and run them,
+    until the queue is empty or the invocation has not enough time left for another unit
+
+    A claimed unit stays invisible for the rest of the invocation and is deleted once it is executed.
+    Units of crashed or timed out invocations return to the queue, the retried worker message picks them up.
     Args:
-        bucket_name: the name of the s3 bucket
-        s3_folder: the folder path in the s3 bucket
-        local_dir: a relative or absolute directory path in the local file system
-    """
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    for obj in bucket.objects.filter(Prefix=s3_folder):
-        target = obj.key if local_dir is None \
-            else os.path.join(local_dir, os.path.relpath(obj.key, s3_folder))
-        if not os.path.exists(os.path.dirname(target)):
-            os.makedirs(os.path.dirname(target))
-        if obj.key[-1] == '/':
-            continue
-        bucket.download_file(obj.key, target)
-
-def upload_folder_to_s3(bucket_name, s3_folder, local_dir):
-    """
-    Upload the contents of a folder directory
+        worker: the body of the worker message sent by the distributor
+        run_unit: runs the body of a unit message like a shard, returns True if it is executed
+        context: the Lambda context, None runs until the queue is empty
+    Returns:
+        True if every claimed unit is executed, False to retry the worker message
+    """
+    sqs = container.sqs_client()
+    queue_url = os.environ['WorkUnitQueueName']
+    executed, all_executed, longest = 0, True, 0
+    while True:
+        remaining = context.get_remaining_time_in_millis() if context is not None else None
+        # the next unit probably takes as long as the longest unit so far
+        if remaining is not None and remaining < max(MIN_REMAINING_TIME_FOR_SHARD, longest * 1.5):
+            # units may be left, a new worker continues with them
+            print(f"Not enough time left for another work unit, starting a new worker for run {worker.get('run_id')}")
+            sqs.send_message(QueueUrl=os.environ['TestJobQueueName'], MessageBody=json.dumps(worker))
+            break
+        response = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=WORK_UNIT_WAIT_SECONDS,
+                                       VisibilityTimeout=remaining // 1000 if remaining is not None else 900)
+        messages = response.get('Messages', [])
+        if not messages:
+            break
+        start = time.monotonic()
+        if run_unit(json.loads(messages[0]['Body'])):
+            sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=messages[0]['ReceiptHandle'])
+            executed += 1
+        else:
+            all_executed = False
+        longest = max(longest, (time.monotonic() - start) * 1000)
+    count('WorkUnits', executed)
+    print(f"Worker {worker.get('worker')} of run {worker.get('run_id')} executed {executed} work units")
+    return all_executed
+
+
+def execute_shard(payload, test_run_table, processes=1, options=None):
+    """
+    Execute the tests of one shard and upload the results
     Args:
-        bucket_name: the name of the s3 bucket
-        s3_folder: the folder path in the s3 bucket
-        local_dir: a relative or absolute directory path in the local file system
+        payload: the body of the SQS message sent by the distributor
+        test_run_table: the TestRunTable, the status of the job is updated in it
+        processes: the number of parallel Robot Framework processes for the shard
+        options: more Robot Framework options, e.g. the prerunmodifier of the persistent browser
     """
-    client = boto3.client('s3')
+    testsbucket_name = os.environ['TestsBucketName']
+    resultsbucket_name = os.environ['ResultsBucketName']
+    run_id = payload.get("run_id", None)
+    job_id = payload.get("job_id", None)
+    project = payload.get('project', None)
+    tests = payload.get('tests', None)
+    run_record = get_record(test_run_table, run_id, RUN_RECORD)
+    if run_record is not None and run_record.get('cancelled'):
+        # the shard counts as done without running, so the merger still builds the report of the executed shards
+        print(f"Run {run_id} is cancelled ({run_record.get('cancel_reason')}), dropping shard {job_id}")
+        count('CancelledShards')
+        complete_job(test_run_table, payload, 'CANCELLED')
+        return
+    if not set_test_job_status(test_run_table, run_id, job_id, "IN_PROGRESS", only_startable=True):
+        # SQS delivers messages at least once, a job which is done already is not executed again
+        print(f"Job {job_id} is already done, skipping it")
+        count('DuplicateShards')
+        return
+    shard_content = payload.get('shard_content', None)
+    if shard_content is None:
+        with timer('LoadShard'):
+            shard_content = load_shard(resultsbucket_name, payload['manifest'], payload['shard_name'])
+    bundle = payload.get('bundle', None)
+    content_version = payload.get('content_version', None)
 
-    # enumerate local files recursively
-    for root, dirs, files in os.walk(local_dir):
+    def fetch_project(local_dir):
+        if bundle:
+            # one streaming request for the whole project, prepared by the distributor
+            size = extract_bundle(resultsbucket_name, bundle, local_dir)
+            print(f"Extracted project bundle {bundle} ({size} bytes)")
+        else:
+            download_s3_folder(testsbucket_name, project, local_dir)
 
-        for filename in files:
+    # a batch usually holds several shards of the same run, only the first one downloads the project
+    with timer('Project'):
+        project_dir, cache_hit = get_project(project, content_version if bundle else None, fetch_project)
+    results_dir = f'/tmp/results/{project}/{run_id}/{job_id}'
+    try:
+        count('ProjectCacheHits' if cache_hit else 'ProjectCacheMisses')
+        print(f"Project cache {'hit' if cache_hit else 'miss'}: {project} {content_version}")
+        print(str(payload))
+        report_progress(test_run_table, payload, {'status': 'IN_PROGRESS', 'started': Decimal(str(round(time.time(), 3)))})
+        if run_record is not None:
+            # stops the shard when the run is cancelled or exceeds its failure threshold while the shard runs
+            options = merge_options(options or {}, {'listener': [f'fail_fast.FailFast:{run_id}']})
+        with timer('Execute'):
+            # Robot Framework runs in-process only in the main thread, concurrent shards run it in subprocesses
+            if processes > 1 or threading.current_thread() is not threading.main_thread():
+                run_parallel(f'{project_dir}/{tests}', shard_content, results_dir, f'{job_id}.xml', processes,
+                             allure_dir=f'{results_dir}/allure-results', options=options)
+            else:
+                # only imported by the code path which uses it, it is not needed to start the container
+                from allure_robotframework import allure_robotframework
+                robot_options = merge_options(shard_options(shard_content), options or {})
+                listeners = [allure_robotframework(f'{results_dir}/allure-results'), *robot_options.pop('listener', [])]
+                run(f'{project_dir}/{tests}', outputdir=results_dir, report=None, log=None, output=f'{job_id}.xml',
+                    listener=listeners, **robot_options)
+        summary = shard_summary(f'{results_dir}/{job_id}.xml', payload.get('shard_name'))
+        # next to the output, so the statistics of a shard can be read without parsing the output
+        with open(f'{results_dir}/{job_id}.json', 'w') as f:
+            json.dump(summary, f)
+        with timer('Upload'):
+            if payload.get('allure_archive') and os.path.isdir(f'{results_dir}/allure-results'):
+                # one object instead of a few files per test, the merger combines the archives of the run
+                size = upload_bundle(resultsbucket_name, f'{project}/results/{run_id}/allure/{job_id}.tar.gz', f'{results_dir}/allure-results')
+                print(f"Uploaded Allure results archive of job {job_id} ({size} bytes)")
+                shutil.rmtree(f'{results_dir}/allure-results')
+            upload_s3_folder(resultsbucket_name, f'{project}/results/{run_id}', results_dir)
+    finally:
+        # Delete the results, the project stays cached for the next shard of this container
+        shutil.rmtree(results_dir, ignore_errors=True)
+        release_project(project_dir)
+    summary['phases'] = phases()
+    set_test_job_summary(test_run_table, run_id, job_id, summary)
+    with timer('Complete'):
+        complete_job(test_run_table, payload, summary=summary)
 
-            # construct the full local path
-            local_path = os.path.join(root, filename)
 
-            # construct the full Dropbox path
-            relative_path = os.path.relpath(local_path, local_dir)
-            s3_path = os.path.join(s3_folder, relative_path)
+def load_shard(bucket_name, manifest, shard_name):
+    """
+    Resolve the tests of a shard from the manifest of its run
+    The manifest is fetched once per run and container, see store_shard_manifest in the distributor
+    Returns:
+        list of dicts with suite, test and datadriver
+    """
+    with _manifests_lock:
+        if manifest not in _manifests:
+            # a container works on few runs at the same time, only the latest manifests are kept
+            while len(_manifests) >= MAX_CACHED_MANIFESTS:
+                _manifests.pop(next(iter(_manifests)))
+            _manifests[manifest] = json.loads(s3_client().get_object(Bucket=bucket_name, Key=manifest)['Body'].read())
+        content = _manifests[manifest]
+    shard = content['shards'][shard_name]
+    suite = content['inventory']['suites'][shard['suite']]
+    return [{'suite': suite['name'], 'test': suite['tests'][index], 'datadriver': suite['datadriver']} for index in shard['tests']]
 
-            # relative_path = os.path.relpath(os.path.join(root, filename))
 
-            print(f'Searching {s3_path} in {bucket_name}')
-            try:
-                client.head_object(Bucket=bucket_name, Key=s3_path)
-                print(f"Path found on S3! Skipping {s3_path}")
+@timed('Summary')
+def shard_summary(output, shard_name):
+    """
+    Return the statistics of a shard as a small dict: counts, elapsed seconds and the failed tests
+    Only the first MAX_FAILED_TESTS failed tests are listed, failed_total has the full count
+    """
+    result = ExecutionResult(output)
+    statistics = result.suite.statistics
+    failed_tests = [test.longname for test in result.suite.all_tests if test.status == 'FAIL']
+    return {
+        'shard_name': shard_name,
+        'passed': statistics.passed,
+        'failed': statistics.failed,
+        'skipped': statistics.skipped,
+        'total': statistics.total,
+        'elapsed': round(result.suite.elapsedtime / 1000, 3),
+        'failed_tests': failed_tests[:MAX_FAILED_TESTS],
+    }
 
-                # try:
-                    # client.delete_object(Bucket=bucket, Key=s3_path)
-                # except:
-                    # print "Unable to delete %s..." % s3_path
-            except:
-                print("Uploading {s3_path}...")
-                client.upload_file(local_path, bucket_name, s3_path)
+
+def complete_job(table, payload, status='EXECUTED', summary=None):
+    """
+    Set the final status of the job and count it in the run record and its merge group
+    The merger is invoked for the merge group once all of its jobs are counted,
+    for runs without merge groups once all jobs of the run are counted, see invoke_merger_once
+    Args:
+        status: EXECUTED, or CANCELLED for a job which was dropped because its run is cancelled
+        summary: the summary of an executed shard, its tests are counted in the run record
+    """
+    run_id = payload.get("run_id", None)
+    job_id = payload.get("job_id", None)
+    project = payload.get('project', None)
+    merge_group = payload.get('merge_group', None)
+    # runs created before the run record existed have no counters
+    run_record = get_record(table, run_id, RUN_RECORD)
+    counters = None
+    if run_record is not None:
+        counters = {'completed_shards': 1}
+        if summary is not None:
+            counters.update({'tests_executed': summary['total'], 'tests_passed': summary['passed'],
+                             'tests_failed': summary['failed'], 'tests_skipped': summary['skipped']})
+    # the status and the counters are written in one transaction, a retry after a failure counts the job once
+    if not count_job(table, run_id, job_id, status, counters, merge_group):
+        # SQS delivers messages at least once, a job is only counted the first time,
+        # the merger is still invoked if the attempt which counted the job failed before invoking it
+        print(f"Job {job_id} is already done")
+        if run_record is not None:
+            invoke_merger_once(table, payload, get_record(table, run_id, RUN_RECORD))
+        return
+    if run_record is not None:
+        run_record = get_record(table, run_id, RUN_RECORD)
+        reason = None if run_record.get('cancelled') else failure_threshold_exceeded(run_record)
+        if reason is not None:
+            print(f"Cancelling run {run_id}: {reason}")
+            cancel_run(table, run_id, reason)
+    if summary is None:
+        report_progress(table, payload, {'status': status})
+    else:
+        # only the first failures of a run are listed, the progress record stays small
+        failures_before = int(run_record.get('tests_failed', 0)) - summary['failed'] if run_record is not None else 0
+        failed_tests = summary['failed_tests'][:MAX_PROGRESS_FAILURES_PER_SHARD] if failures_before < MAX_PROGRESS_FAILURES else []
+        report_progress(table, payload, {'status': status, 'elapsed': Decimal(str(summary['elapsed'])),
+                                         **{counter: summary[counter] for counter in ('passed', 'failed', 'skipped')}},
+                        failed_tests)
+    if run_record is not None:
+        invoke_merger_once(table, payload, run_record)
+    elif is_run_executed(table, run_id):
+        invoke_merger({"run_id": run_id, "project": project})
 
 
-def set_test_job_status(table, run_id, job_id, job_status):
+def invoke_merger_once(table, payload, run_record):
+    """
+    Invoke the merger for the merge group of the job, or for runs without merge groups for the run,
+    once all of its jobs are counted
+    The counters are read after the jobs are counted, so several jobs may see the total,
+    only the one which claims merge_invoked invokes the merger
+    """
+    run_id = payload.get("run_id", None)
+    project = payload.get('project', None)
+    merge_group = payload.get('merge_group', None)
+    if merge_group is not None:
+        record_id = group_record(merge_group)
+        record = get_record(table, run_id, record_id)
+        executed = record['completed'] >= record['total']
+        merger_payload = {"run_id": run_id, "project": project, "merge_group": merge_group}
+    else:
+        record_id, record = RUN_RECORD, run_record
+        executed = 'total_shards' in record and record['completed_shards'] >= record['total_shards']
+        merger_payload = {"run_id": run_id, "project": project}
+    if not executed or not claim(table, run_id, record_id, 'merge_invoked'):
+        return
+    if merge_group is not None:
+        print(f"Merge group {merge_group} of run {run_id} is executed")
+    try:
+        invoke_merger(merger_payload)
+    except Exception:
+        # the retry of the message invokes the merger
+        release(table, run_id, record_id, 'merge_invoked')
+        raise
+
+
+def report_progress(table, payload, shard, failed_tests=None):
+    """
+    Set the status of a shard in the progress record of its run and append failed tests
+    The progress is informational, an error is logged and the shard goes on
+    """
+    try:
+        update_progress(table, payload.get('run_id'), payload.get('shard_number'), shard,
+                        {'failed_tests': failed_tests} if failed_tests else None)
+    except ClientError as err:
+        logger.error(
+            "Couldn't update the progress of test_run %s, test_job %s in table %s. Here's why: %s: %s",
+            payload.get('run_id'), payload.get('job_id'), table.name,
+            err.response['Error']['Code'], err.response['Error']['Message'])
+
+
+def invoke_merger(payload):
+    # Execute the merger lambda function
+    container.lambda_client().invoke(FunctionName=os.environ['MergerFunctionName'], InvocationType='Event', Payload=json.dumps(payload))
+
+
+def set_test_job_status(table, run_id, job_id, job_status, only_startable=False):
+    """
+    Args:
+        only_startable: only update a job whose status is in STARTABLE_JOB_STATUSES
+    Returns:
+        False if only_startable is set and the job is done already, otherwise True
+    """
+    condition, startable = {}, {}
+    if only_startable:
+        startable = {f':startable{number}': status for number, status in enumerate(STARTABLE_JOB_STATUSES)}
+        condition = {'ConditionExpression': f"attribute_not_exists(job_status) OR job_status IN ({', '.join(startable)})"}
     try:
         response = table.update_item(
                 Key={'run_id': run_id, 'job_id': job_id},
                 UpdateExpression="set job_status=:s",
                 ExpressionAttributeValues={
-                    ':s': job_status},
-                ReturnValues="UPDATED_NEW")
+                    ':s': job_status, **startable},
+                ReturnValues="UPDATED_NEW",
+                **condition)
     except ClientError as err:
+        if only_startable and err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
         logger.error(
             "Couldn't update test_run %s, test_job %s in table %s. Here's why: %s: %s",
             run_id, job_id, table.name,
             err.response['Error']['Code'], err.response['Error']['Message'])
+    return True
 
-def is_run_executed(table, run_id):
-        try:
-            response = table.query(KeyConditionExpression=Key('run_id').eq(run_id))
-        except ClientError as err:
-            logger.error(
-                "Couldn't query for test_runs with run_id in %s. Here's why: %s: %s", run_id,
-                err.response['Error']['Code'], err.response['Error']['Message'])
-            raise
-        else:
-            # If all items in response['Items'] have item['job_status'] == COMPLETED, return True
-            # Otherwise, return False
-            return all(item['job_status'] == 'EXECUTED' for item in response['Items'])
\ No newline at end of file
+def set_test_job_summary(table, run_id, job_id, summary):
+    """
+    Store the summary of a shard in its job item, the merger answers status requests from it
+    Raises:
+        ClientError if the item can not be updated, the shard is retried
+    """
+    values = {
+        'passed': summary['passed'], 'failed': summary['failed'], 'skipped': summary['skipped'],
+        'total': summary['total'], 'elapsed': Decimal(str(summary['elapsed'])),
+        'failed_tests': summary['failed_tests'],
+        'phases': {phase: Decimal(str(seconds)) for phase, seconds in summary.get('phases', {}).items()},
+        'shard_name': summary['shard_name']}
+    try:
+        # every attribute goes through a name placeholder, e.g. total is a reserved word of DynamoDB
+        table.update_item(
+                Key={'run_id': run_id, 'job_id': job_id},
+                UpdateExpression="set " + ", ".join(f'#{name}=:{name}' for name in values),
+                ExpressionAttributeNames={f'#{name}': name for name in values},
+                ExpressionAttributeValues={f':{name}': value for name, value in values.items()})
+    except ClientError as err:
+        logger.error(
+            "Couldn't update the summary of test_run %s, test_job %s in table %s. Here's why: %s: %s",
+            run_id, job_id, table.name,
+            err.response['Error']['Code'], err.response['Error']['Message'])
+        raise
@@ -0,0 +1,62 @@
+"""
+Pre-run modifier which makes the tests of a shard use the browser server of the container
+
+Launching a browser takes seconds on Lambda, often longer than the test which uses it.
+With PersistentBrowser the executor keeps a browser server running for the lifetime of the container
+(see container.start_browser_server) and runs Robot Framework with this modifier:
+
+    robot --prerunmodifier browser_reuse.ReuseBrowser tests
+
+It replaces the `New Browser` calls of the suites with `Connect To Browser` to the server.
+The tests create their contexts and pages as before, so every shard gets fresh contexts in a shared browser.
+Closing a connected browser, e.g. by the automatic closing of the Browser library at the end of a suite,
+only disconnects from the server and closes the contexts of the shard.
+
+Only the tests, setups, teardowns and keywords of the suite files are modified. Keywords in resource files
+can connect to the server themselves with `Connect To Browser    %{BROWSER_WS_ENDPOINT}`.
+"""
+import os
+from robot.api import SuiteVisitor
+
+ENDPOINT_VARIABLE = 'BROWSER_WS_ENDPOINT'
+NEW_BROWSER = {'newbrowser', 'browser.newbrowser'}
+
+
+def normalize(name):
+    return name.lower().replace(' ', '').replace('_', '')
+
+
+def requested_browser(args):
+    """The browser argument of a New Browser call, chromium if it is not given"""
+    for arg in args:
+        if '=' in arg:
+            name, value = arg.split('=', 1)
+            if normalize(name) == 'browser':
+                return value.lower()
+        else:
+            # the first positional argument of New Browser is the browser
+            return arg.lower()
+    return 'chromium'
+
+
+class ReuseBrowser(SuiteVisitor):
+
+    def __init__(self):
+        self.endpoint = os.environ.get(ENDPOINT_VARIABLE)
+        self.browser = os.environ.get('PersistentBrowser', 'chromium').lower()
+
+    def start_suite(self, suite):
+        if not self.endpoint:
+            return False
+        for keyword in suite.resource.keywords:
+            keyword.body.visit(self)
+        return None
+
+    def start_keyword(self, keyword):
+        if normalize(keyword.name or '') not in NEW_BROWSER:
+            return
+        # other browsers than the one of the server are launched as before
+        if requested_browser(keyword.args) != self.browser:
+            return
+        keyword.name = 'Browser.Connect To Browser'
+        keyword.args = (self.endpoint, f'browser={self.browser}')
@@ -0,0 +1,231 @@
+"""
+State of an executor container, created once and reused by every invocation
+
+- the DynamoDB table handles and the Lambda client, with connection pools sized for the concurrent shards
+- the thread pool of the concurrent shards, so its threads and their table handles survive warm invocations
+- optionally the Playwright process of the Browser library, started during the init phase of the container
+- optionally a browser server, launched once per container, the tests of every shard connect to it, see browser_reuse.py
+"""
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from parallel import EXECUTOR_WORKERS
+from rflambda.metrics import count
+
+# Start the Playwright process of the Browser library during the init phase, see start_playwright
+PRELAUNCH_BROWSER = os.environ.get('PrelaunchBrowser', 'false').lower() == 'true'
+# The Browser library connects to a running Playwright process on this port instead of starting its own
+BROWSER_PORT_VARIABLE = 'ROBOT_FRAMEWORK_BROWSER_NODE_PORT'
+PLAYWRIGHT_START_TIMEOUT = 20
+# Browser (chromium, firefox or webkit) of the browser server which is kept running for the lifetime of the container
+PERSISTENT_BROWSER = os.environ.get('PersistentBrowser', '').lower()
+# The tests and the browser_reuse prerunmodifier read the endpoint of the browser server from this variable
+BROWSER_ENDPOINT_VARIABLE = 'BROWSER_WS_ENDPOINT'
+# Lambda has neither a user namespace for the sandbox nor a /dev/shm
+BROWSER_SERVER_ARGS = {'chromium': ['--no-sandbox', '--disable-dev-shm-usage', '--disable-gpu']}
+# Launches the browser server with the Playwright package of the Browser library and prints its endpoint
+BROWSER_SERVER_SCRIPT = """
+let playwright;
+try { playwright = require('playwright'); } catch (error) { playwright = require('playwright-core'); }
+playwright[process.env.BROWSER_NAME].launchServer({headless: true, args: JSON.parse(process.env.BROWSER_ARGS)})
+  .then(server => console.log(server.wsEndpoint()))
+  .catch(error => { console.error(error); process.exit(1); });
+"""
+
+_config = Config(max_pool_connections=max(10, EXECUTOR_WORKERS * 4), retries={'max_attempts': 10, 'mode': 'adaptive'})
+_session = boto3.session.Session()
+_lambda_client = _session.client('lambda', config=_config)
+_sqs_client = _session.client('sqs', config=_config)
+# boto3 resources are not thread safe, every thread gets its own table handles
+_local = threading.local()
+_shard_pool = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix='shard') if EXECUTOR_WORKERS > 1 else None
+_playwright = None
+_playwright_lock = threading.Lock()
+_browser_server = None
+_browser_endpoint = None
+_browser_server_lock = threading.Lock()
+
+
+def table(name):
+    """Return a handle of a DynamoDB table for the current thread"""
+    tables = getattr(_local, 'tables', None)
+    if tables is None:
+        # a session per thread, the default session of boto3 is not thread safe either
+        _local.resource = boto3.session.Session().resource('dynamodb', config=_config)
+        tables = _local.tables = {}
+    if name not in tables:
+        tables[name] = _local.resource.Table(name)
+    return tables[name]
+
+
+def lambda_client():
+    """Low level clients are thread safe, one client serves all threads"""
+    return _lambda_client
+
+
+def sqs_client():
+    return _sqs_client
+
+
+def shard_pool():
+    """The thread pool of concurrent shards, None with a single worker"""
+    return _shard_pool
+
+
+def playwright_wrapper():
+    """The folder of the Playwright wrapper of the Browser library, found without importing the library"""
+    spec = importlib.util.find_spec('Browser')
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    wrapper = os.path.join(spec.submodule_search_locations[0], 'wrapper')
+    return wrapper if os.path.exists(os.path.join(wrapper, 'index.js')) else None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_playwright():
+    """
+    Start the Playwright process of the Browser library and make the library connect to it
+    The process starts in the background while the function initializes,
+    so the first test which opens a browser does not wait for it.
+    Returns:
+        the process, None if the Browser library is not installed
+    """
+    global _playwright
+    with _playwright_lock:
+        if _playwright is not None and _playwright.poll() is None:
+            return _playwright
+        wrapper = playwright_wrapper()
+        if wrapper is None:
+            print("Browser library not found, the Playwright process is not started")
+            return None
+        port = free_port()
+        log = open(os.path.join('/tmp', 'playwright-log.txt'), 'a')
+        _playwright = subprocess.Popen(['node', os.path.join(wrapper, 'index.js'), str(port)],
+                                       cwd=wrapper, stdout=log, stderr=subprocess.STDOUT)
+        # robot runs in this process and in its worker subprocesses, both read the port from the environment
+        os.environ[BROWSER_PORT_VARIABLE] = str(port)
+        print(f"Started Playwright process {_playwright.pid} on port {port}")
+        return _playwright
+
+
+def ensure_playwright(timeout=PLAYWRIGHT_START_TIMEOUT):
+    """
+    Wait until the pre-launched Playwright process accepts connections
+    If it died, the Browser library starts its own process like without a pre-launched one
+    Returns:
+        True if the Browser library can use the pre-launched process
+    """
+    process = _playwright
+    if process is None:
+        return False
+    port = int(os.environ.get(BROWSER_PORT_VARIABLE, 0))
+    deadline = time.monotonic() + timeout
+    while process.poll() is None and time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    print(f"Playwright process {process.pid} is not available, the Browser library starts its own")
+    os.environ.pop(BROWSER_PORT_VARIABLE, None)
+    return False
+
+
+def endpoint_port(endpoint):
+    """The port of a ws://host:port/path endpoint"""
+    return int(endpoint.split('://', 1)[1].split('/', 1)[0].rsplit(':', 1)[1])
+
+
+def browser_server_healthy():
+    """True if the browser server is running and accepts connections"""
+    if _browser_server is None or _browser_server.poll() is not None:
+        return False
+    try:
+        socket.create_connection(('127.0.0.1', endpoint_port(_browser_endpoint)), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def stop_browser_server():
+    global _browser_server, _browser_endpoint
+    if _browser_server is not None and _browser_server.poll() is None:
+        _browser_server.kill()
+        _browser_server.wait()
+    _browser_server = _browser_endpoint = None
+    os.environ.pop(BROWSER_ENDPOINT_VARIABLE, None)
+
+
+def start_browser_server(timeout=PLAYWRIGHT_START_TIMEOUT):
+    """
+    Launch the browser server and publish its endpoint in the BROWSER_WS_ENDPOINT environment variable
+    Returns:
+        the endpoint, None if the server could not be started
+    """
+    global _browser_server, _browser_endpoint
+    wrapper = playwright_wrapper()
+    if wrapper is None:
+        print("Browser library not found, the browser server is not started")
+        return None
+    environment = {**os.environ, 'BROWSER_NAME': PERSISTENT_BROWSER,
+                   'BROWSER_ARGS': json.dumps(BROWSER_SERVER_ARGS.get(PERSISTENT_BROWSER, [])),
+                   # the browsers are installed next to the Playwright package of the Browser library, see rfbrowser init
+                   'PLAYWRIGHT_BROWSERS_PATH': os.environ.get('PLAYWRIGHT_BROWSERS_PATH', '0')}
+    # require resolves the Playwright package from the node_modules folder of the wrapper
+    process = subprocess.Popen(['node', '-e', BROWSER_SERVER_SCRIPT], cwd=wrapper, env=environment,
+                               stdout=subprocess.PIPE, stderr=open(os.path.join('/tmp', 'browser-server-log.txt'), 'a'),
+                               text=True)
+    ready = threading.Event()
+    lines = []
+
+    def read_endpoint():
+        lines.append(process.stdout.readline().strip())
+        ready.set()
+    threading.Thread(target=read_endpoint, daemon=True).start()
+    if not ready.wait(timeout) or not lines[0].startswith('ws'):
+        print(f"Browser server {PERSISTENT_BROWSER} did not start within {timeout} seconds, see /tmp/browser-server-log.txt")
+        process.kill()
+        process.wait()
+        return None
+    _browser_server, _browser_endpoint = process, lines[0]
+    os.environ[BROWSER_ENDPOINT_VARIABLE] = _browser_endpoint
+    count('BrowserServerStarts')
+    print(f"Started browser server {PERSISTENT_BROWSER} {process.pid} on {_browser_endpoint}")
+    return _browser_endpoint
+
+
+def browser_endpoint():
+    """
+    Return the endpoint of the browser server of the container, restart the server if it is not healthy
+    Without PersistentBrowser, or if the server does not start, the tests launch their own browsers
+    Returns:
+        the ws endpoint or None
+    """
+    if not PERSISTENT_BROWSER:
+        return None
+    with _browser_server_lock:
+        if browser_server_healthy():
+            return _browser_endpoint
+        if _browser_server is not None:
+            print(f"Browser server {_browser_server.pid} is not healthy, restarting it")
+        stop_browser_server()
+        return start_browser_server()
+
+
+if PRELAUNCH_BROWSER:
+    start_playwright()
+if PERSISTENT_BROWSER:
+    # started during the init phase, the first shard of the container does not wait for it
+    browser_endpoint()
@@ -0,0 +1,69 @@
+"""
+Listener which stops a running shard when its run is cancelled or exceeds its failure threshold
+
+    robot --listener fail_fast.FailFast:<run_id> tests
+
+After every failed test the listener checks the failure threshold of the run
+(see rflambda.runstate.failure_threshold_exceeded) against the counters of the run record
+and the tests this shard executed so far. At most every CHECK_INTERVAL seconds it reads the run record again,
+to see the tests of other shards and if the run was cancelled.
+
+Robot Framework is stopped gracefully like with Ctrl-C: the running keyword finishes,
+the remaining tests fail as not run and the output of the shard is written,
+so the merger includes the shard in the partial report of the run.
+
+The first failed test of the shard is added to the first_failures of the progress record right away,
+so clients of the progress view see it before the shard ends.
+"""
+import os
+import signal
+import time
+import boto3
+from rflambda.runstate import RUN_RECORD, cancel_run, failure_threshold_exceeded, get_record, update_progress
+
+# Seconds between two reads of the run record
+CHECK_INTERVAL = 10
+# First failures of all shards listed in the progress record
+MAX_FIRST_FAILURES = 50
+
+
+class FailFast:
+    ROBOT_LISTENER_API_VERSION = 3
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.table = boto3.resource('dynamodb').Table(os.environ['TestRunTableName'])
+        self.run_record = None
+        self.last_check = 0
+        self.executed = 0
+        self.failed = 0
+        self.stopping = False
+
+    def end_test(self, data, result):
+        self.executed += 1
+        if result.failed:
+            self.failed += 1
+            if self.failed == 1 and not self.stopping:
+                # longname is called full_name since Robot Framework 7
+                name = getattr(result, 'full_name', None) or result.longname
+                update_progress(self.table, self.run_id, append={'first_failures': [name]}, max_items=MAX_FIRST_FAILURES)
+        if self.stopping:
+            return
+        if self.run_record is None or time.monotonic() - self.last_check >= CHECK_INTERVAL:
+            self.last_check = time.monotonic()
+            self.run_record = get_record(self.table, self.run_id, RUN_RECORD) or {}
+            if self.run_record.get('cancelled'):
+                self.stop(self.run_record.get('cancel_reason', 'cancelled'))
+                return
+        if result.failed:
+            reason = failure_threshold_exceeded(self.run_record, self.executed, self.failed)
+            if reason is not None:
+                # the other shards of the run see the flag before they start or at their next check
+                cancel_run(self.table, self.run_id, reason)
+                self.stop(reason)
+
+    def stop(self, reason):
+        self.stopping = True
+        print(f"Stopping run {self.run_id}: {reason}")
+        # the signal handler of Robot Framework stops the execution gracefully
+        os.kill(os.getpid(), signal.SIGINT)
@@ -0,0 +1,131 @@
+import os
+import shutil
+import subprocess
+import sys
+from robot.api import ExecutionResult
+
+# Number of Robot Framework processes an executor container runs in parallel
+EXECUTOR_WORKERS = int(os.environ.get('ExecutorWorkers', 1))
+# Robot Framework returns the number of failed tests up to 250, higher return codes are errors of the run itself
+MAX_TESTS_RETURN_CODE = 250
+
+
+def shard_options(shard_content):
+    """
+    Return the Robot Framework options which select the tests of a shard
+    DataDriver suites select their tests with the DYNAMICTESTS variable,
+    other suites with --test
+    """
+    if shard_content[0]["datadriver"]:
+        dynamictest_list = "|".join([test["suite"] + "." + test["test"] for test in shard_content])
+        return {'variable': ["DYNAMICTESTS:" + dynamictest_list], 'suite': [shard_content[0]["suite"]]}
+    # Create list of strings in test_list with format test["suite"].test["test"]
+    test_list = ["*" + test["suite"] + "." + test["test"] for test in shard_content]
+    return {'test': test_list, 'suite': [shard_content[0]["suite"]]}
+
+
+def merge_options(*options):
+    """Combine dicts of Robot Framework options, the values of an option are lists and are concatenated"""
+    merged = {}
+    for option in options:
+        for name, values in option.items():
+            merged.setdefault(name, []).extend(values)
+    return merged
+
+
+def split_shard(shard_content, parts):
+    """Split the tests of a shard into at most `parts` consecutive parts of similar size"""
+    parts = max(1, min(parts, len(shard_content)))
+    size, extra = divmod(len(shard_content), parts)
+    chunks = []
+    start = 0
+    for number in range(parts):
+        end = start + size + (1 if number < extra else 0)
+        chunks.append(shard_content[start:end])
+        start = end
+    return chunks
+
+
+def run_parallel(data_source, shard_content, outputdir, output, processes, allure_dir=None, options=None):
+    """
+    Run the tests of a shard in parallel Robot Framework processes
+    and combine their outputs into one output file
+
+    Every process gets its own output folder. Subprocesses are used instead of
+    a multiprocessing pool, because Lambda has no /dev/shm for its queues.
+    Args:
+        data_source: the tests path which is passed to robot
+        shard_content: the list of tests of the shard
+        outputdir: the folder of the combined output file
+        output: the file name of the combined output file
+        processes: the maximum number of parallel processes
+        allure_dir: folder for the allure_robotframework listener, None disables it
+        options: more Robot Framework options for every process, a dict of lists like shard_options returns
+    Returns:
+        the path of the combined output file
+    """
+    workers_dir = os.path.join(outputdir, 'workers')
+    running = []
+    for number, part in enumerate(split_shard(shard_content, processes)):
+        worker_dir = os.path.join(workers_dir, str(number))
+        os.makedirs(worker_dir)
+        arguments = ['--outputdir', worker_dir, '--output', 'output.xml', '--report', 'NONE', '--log', 'NONE']
+        if allure_dir:
+            arguments += ['--listener', f'allure_robotframework:{allure_dir}']
+        for name, values in merge_options(shard_options(part), options or {}).items():
+            for value in values:
+                arguments += [f'--{name}', value]
+        # an argument file keeps long test lists away from the command line length limit
+        argumentfile = os.path.join(worker_dir, 'arguments.txt')
+        with open(argumentfile, 'w') as f:
+            f.write('\n'.join(arguments))
+        running.append((worker_dir, subprocess.Popen(
+            [sys.executable, '-m', 'robot', '--argumentfile', argumentfile, data_source])))
+    outputs, failures = [], []
+    for worker_dir, process in running:
+        process.wait()
+        # above 250 Robot Framework itself failed, e.g. with invalid data or an unexpected error,
+        # below 0 the process was killed, e.g. when the function ran out of memory
+        if process.returncode < 0 or process.returncode > MAX_TESTS_RETURN_CODE:
+            failures.append(f"worker {os.path.basename(worker_dir)} exited with {process.returncode}")
+        elif not os.path.exists(os.path.join(worker_dir, 'output.xml')):
+            failures.append(f"worker {os.path.basename(worker_dir)} created no output file")
+        else:
+            outputs.append(os.path.join(worker_dir, 'output.xml'))
+    if failures:
+        # the tests of the failed workers would be missing from the run, the shard is retried instead
+        raise RuntimeError(f"Workers of {output} failed: {', '.join(failures)}")
+    path = os.path.join(outputdir, output)
+    combine_outputs(outputs, path)
+    shutil.rmtree(workers_dir, ignore_errors=True)
+    return path
+
+
+def combine_outputs(outputs, path):
+    """
+    Combine outputs of runs which executed different tests of the same suites
+    into one output file with the suite structure of a single run
+
+    rebot --merge would mark every test of the later outputs as "added from merged output"
+    """
+    result = ExecutionResult(outputs[0])
+    for output in outputs[1:]:
+        other = ExecutionResult(output)
+        append_suite(result.suite, other.suite)
+        result.errors.messages.extend(other.errors.messages)
+    result.save(path)
+
+
+def append_suite(target, source):
+    target.tests.extend(source.tests)
+    for suite in source.suites:
+        match = next((child for child in target.suites if child.name == suite.name), None)
+        if match is None:
+            target.suites.append(suite)
+        else:
+            append_suite(match, suite)
+    # the combined suite starts with the first and ends with the last process
+    if source.starttime and (not target.starttime or source.starttime < target.starttime):
+        target.starttime = source.starttime
+    if source.endtime and (not target.endtime or source.endtime > target.endtime):
+        target.endtime = source.endtime
@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import threading
+
+CACHE_ROOT = '/tmp/projects'
+# Share of the ephemeral storage the cached projects may use,
+# the rest is left for the results, the browser and temporary files of the tests
+CACHE_SHARE = 0.5
+# Shards of a batch may run in parallel threads, the lock guards the bookkeeping below, never a download
+_lock = threading.Lock()
+# Number of running shards per project folder, folders in use are never evicted
+_in_use = {}
+# Folders which are being fetched, the other shards which need the same folder wait for the event
+_fetching = {}
+# Suffix of a folder which is being fetched, a failed fetch never leaves a half filled cache entry
+PARTIAL = '.partial'
+
+
+def cache_limit():
+    """The cache size in bytes, derived from the EphemeralStorage size of the function in MB"""
+    return int(int(os.environ.get('EphemeralStorageSize', 512)) * 1024 * 1024 * CACHE_SHARE)
+
+
+def folder_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+
+def get_project(project, content_version, fetch):
+    """
+    Return the local folder of a project in the given content version
+    A warm Lambda container keeps the folder in /tmp, so later invocations
+    for the same content version skip the download.
+    Only one shard fetches a folder, shards which need other folders do not wait for it.
+    Args:
+        project: the project folder in the s3 bucket
+        content_version: the content hash of the project, None disables the cache
+        fetch: function which downloads the project into the folder passed to it
+    The folder is in use until it is passed to release_project.
+    Returns:
+        tuple of the local folder and True for a cache hit, False for a miss
+    """
+    if not content_version:
+        # without a version the content can not be reused, always fetch a fresh copy,
+        # it is deleted by release_project
+        os.makedirs(os.path.join(CACHE_ROOT, project), exist_ok=True)
+        path = tempfile.mkdtemp(prefix='unversioned-', dir=os.path.join(CACHE_ROOT, project))
+        with _lock:
+            _in_use[path] = 1
+        try:
+            fetch(path)
+        except Exception:
+            release_project(path)
+            raise
+        evict(keep=path)
+        return path, False
+    path = os.path.join(CACHE_ROOT, project, content_version)
+    while True:
+        with _lock:
+            if os.path.isdir(path):
+                # the modification time of the folder is the last use for the LRU eviction
+                os.utime(path)
+                _in_use[path] = _in_use.get(path, 0) + 1
+                return path, True
+            fetching = _fetching.get(path)
+            if fetching is None:
+                fetching = _fetching[path] = threading.Event()
+                break
+        # another shard fetches the folder, if its fetch fails the next waiter fetches it
+        fetching.wait()
+    fetched = False
+    try:
+        shutil.rmtree(path + PARTIAL, ignore_errors=True)
+        fetch(path + PARTIAL)
+        os.rename(path + PARTIAL, path)
+        fetched = True
+    finally:
+        with _lock:
+            if fetched:
+                _in_use[path] = _in_use.get(path, 0) + 1
+            del _fetching[path]
+        fetching.set()
+    evict(keep=path)
+    return path, False
+
+
+def release_project(path):
+    """
+    Release a folder returned by get_project once the shard is done with it
+    Copies without a content version are never reused, they are deleted right away
+    """
+    with _lock:
+        _in_use[path] -= 1
+        if _in_use[path] > 0:
+            return
+        del _in_use[path]
+    if os.path.basename(path).startswith('unversioned-'):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def evict(keep=None, limit=None):
+    """
+    Delete the least recently used projects until the cache fits into its limit
+    Args:
+        keep: folder which is never evicted, e.g. the project of the current invocation,
+            the folders of running shards and folders which are being fetched are never evicted either
+        limit: the cache size in bytes, defaults to cache_limit()
+    """
+    limit = cache_limit() if limit is None else limit
+    entries = []
+    for project in os.listdir(CACHE_ROOT) if os.path.isdir(CACHE_ROOT) else []:
+        for version in os.listdir(os.path.join(CACHE_ROOT, project)):
+            path = os.path.join(CACHE_ROOT, project, version)
+            if path.endswith(PARTIAL):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), path, folder_size(path)))
+            except FileNotFoundError:
+                # evicted or released by another shard thread meanwhile
+                continue
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= limit:
+            break
+        with _lock:
+            if path == keep or path in _in_use or not os.path.isdir(path):
+                continue
+            # once renamed, no shard gets the folder as a cache hit, it is deleted without holding the lock
+            evicted = tempfile.mkdtemp(prefix='evicted-', dir=os.path.dirname(CACHE_ROOT))
+            os.rename(path, os.path.join(evicted, 'project'))
+        print(f"Evicting cached project {path} ({size} bytes)")
+        shutil.rmtree(evicted, ignore_errors=True)
+        total -= size
@@ -2,19 +2,43 @@ import json
 import uuid
 import boto3
 import os
+import random
 import sys
 import shutil
 import datetime
+import time
+from decimal import Decimal
 from robot import rebot, rebot_cli
 from robot.api import ExecutionResult
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
 import logging
+from rflambda.bundle import combine_bundles
+from rflambda.metrics import annotate, instrument, phases, timed, timer
+from rflambda.runstate import (PROGRESS_RECORD, RUN_RECORD, claim, get_record, group_record, increment, is_job_item,
+                               is_run_executed, query_run, release)
+from rflambda.transfer import download_files, download_s3_folder, list_objects, s3_client, upload_s3_folder
+from streaming import merge_outputs
 
 logger = logging.getLogger(__name__)
-import os
+
+# 'rebot' merges with rebot --merge, 'streaming' with merge_outputs, which keeps the memory use bounded
+MERGE_MODE = os.environ.get('MergeMode', 'rebot')
+# Keyword levels kept in the output of a streaming merge, empty keeps all keywords
+MERGE_KEYWORD_DEPTH = int(os.environ['MergeKeywordDepth']) if os.environ.get('MergeKeywordDepth') else None
+# Longest wait of a long-polling progress request, below the 29 seconds timeout of the API Gateway
+MAX_PROGRESS_WAIT = 25
+PROGRESS_POLL_INTERVAL = 1
+# A final merge whose invocation did not finish, e.g. timed out, can be claimed again after the longest Lambda timeout
+FINAL_MERGE_CLAIM_SECONDS = 900
+# Tests not executed in this many merged runs of their project are dropped from its timing history
+TIMINGS_MAX_AGE = int(os.environ.get('TimingsMaxAge', 50))
+# Attempts to write the timing history while other merges of the project write it too
+TIMINGS_RETRIES = 5
+# Failed tests stored with the merged statistics of a rerun in its run record, keeps the item below the DynamoDB limit
+MAX_RUN_FAILED_TESTS = 1000
 
 
+@instrument('merger')
 def lambda_handler(event, context):
     
     http_method = event.get('httpMethod')
@@ -26,11 +50,19 @@ def lambda_handler(event, context):
         project = query_string.get('project', None)
         # Get event['run_id'], default to None
         run_id = query_string.get('run_id', None)
+        # Get event['action'], default to None
+        action = query_string.get('action', None)
+        # Get event['view'], default to None
+        view = query_string.get('view', None)
+        parameters = query_string
     else:
         # Get event['project'], default to None
         project = event.get('project', None)
         # Get event['run_id'], default to None
         run_id = event.get('run_id', None)
+        action = event.get('action', None)
+        view = event.get('view', None)
+        parameters = event
     s3 = boto3.resource('s3')
     dynamodb = boto3.resource('dynamodb')
     resultsbucket_name = os.environ['ResultsBucketName']
@@ -39,30 +71,66 @@ def lambda_handler(event, context):
     # generate filename like 2020-01-01T00:00:00.000Z.txt with current timestamp
     current_timestamp = datetime.datetime.utcnow().isoformat()
 
+    annotate(project=project, run_id=run_id, merge_group=event.get('merge_group'))
+    # sent by the executor which completes a merge group
+    if event.get('merge_group') is not None:
+        return merge_group(test_run_table, resultsbucket_name, project, run_id, event['merge_group'])
+
+    # the progress of a run from its progress record, ?view=progress&since=<version>&wait=<seconds> waits for the next change
+    if view == 'progress':
+        since = int(parameters['since']) if parameters.get('since') not in (None, '') else None
+        return run_progress(test_run_table, run_id, since, float(parameters.get('wait') or 0), context)
+
+    # rebuild the combined Allure results of a run on request, e.g. after a shard was retried
+    if action == 'allure':
+        if not is_run_executed(test_run_table, run_id):
+            return {
+                'statusCode': 202,
+                'body': json.dumps('Run is not fully executed')
+            }
+        files = combine_allure_results(resultsbucket_name, project, run_id)
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "run_id": run_id,
+                "allure_files": files,
+                "allure_results": allure_results_link(resultsbucket_name, project, run_id, archived=True)
+            })
+        }
+
     if is_run_merged(test_run_table, run_id):
-        print('Downloading results folder from s3 bucket to tmp')
-        print(f"project: {project} testsuite: {run_id}")
-        # Download project folder from s3 bucket to tmp
-        download_s3_folder(resultsbucket_name, f'{project}/results/{run_id}/final', f'/tmp/{project}/results/{run_id}/final')
-        result = ExecutionResult(f'/tmp/{project}/results/{run_id}/final/output.xml')
-        set_test_run_status(test_run_table, run_id, "MERGED")
-        tests_passed = result.suite.statistics.passed
-        tests_failed = result.suite.statistics.failed
-        tests_total = result.suite.statistics.total
+        run_record = get_record(test_run_table, run_id, RUN_RECORD) or {}
+        if 'rerun_of' in run_record:
+            # the counters of a rerun only have the tests which were executed again,
+            # the statistics of the whole run are stored by merge_run
+            summary = plain(run_record.get('merged_summary'))
+        else:
+            summary = run_summary(test_run_table, run_id, run_record)
+        if summary is None:
+            # runs executed before the executors counted the tests in the run record
+            print('Downloading results folder from s3 bucket to tmp')
+            print(f"project: {project} testsuite: {run_id}")
+            download_s3_folder(resultsbucket_name, f'{project}/results/{run_id}/final', f'/tmp/{project}/results/{run_id}/final')
+            statistics = ExecutionResult(f'/tmp/{project}/results/{run_id}/final/output.xml').suite.statistics
+            summary = {'passed': statistics.passed, 'failed': statistics.failed, 'total': statistics.total}
         return {
             "statusCode": 200,
             "body": json.dumps({
                 "run_id": run_id,
-                "tests_passed": tests_passed,
-                "tests_failed": tests_failed,
-                "tests_total": tests_total,
+                "tests_passed": summary['passed'],
+                "tests_failed": summary['failed'],
+                "tests_total": summary['total'],
+                "failed_tests": summary.get('failed_tests', []),
                 "download_xml": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/final/output.xml",
                 "download_log": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/final/log.html",
                 "download_report": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/final/report.html",
-                "allure_results": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/allure-results"
+                "allure_results": allure_results_link(resultsbucket_name, project, run_id, run_record.get('allure_archive', False)),
+                "cancelled": bool(run_record.get('cancelled', False)),
+                "cancel_reason": run_record.get('cancel_reason'),
+                "rerun_of": run_record.get('rerun_of'),
+                "content_version": run_record.get('content_version')
             })
         }
-    
 
     # if run is not executed, return 202
     if not is_run_executed(test_run_table, run_id):
@@ -70,23 +138,163 @@ def lambda_handler(event, context):
             'statusCode': 202,
             'body': json.dumps('Run is not fully executed')
         }
-   
+
+    # runs with merge groups are merged by the merger invocation of their last merge group
+    run_record = get_record(test_run_table, run_id, RUN_RECORD)
+    if run_record is not None and run_record.get('merged_groups', 0) < run_record.get('groups', 0):
+        return {
+            'statusCode': 202,
+            'body': json.dumps('Run is being merged')
+        }
+
     if project and run_id:
+        return merge_run(test_run_table, resultsbucket_name, project, run_id, from_partials=run_record is not None)
+    return {
+        'statusCode': 400,
+        'body': json.dumps('project and run_id are required')
+    }
+
+
+def merge_group(test_run_table, resultsbucket_name, project, run_id, group):
+    """
+    Merge the outputs of the shards of one merge group into a partial result,
+    as soon as all shards of the group are executed.
+    The invocation which merges the last group also merges the run from the partial results,
+    so the final merge only combines a few pre-merged outputs.
+    """
+    record = get_record(test_run_table, run_id, group_record(group))
+    group_dir = f'/tmp/{project}/results/{run_id}/groups/{group}'
+    keys = [f'{project}/results/{run_id}/{job_id}.xml' for job_id in record['jobs']]
+    partial = f'{int(group):05d}.xml'
+    if (get_record(test_run_table, run_id, RUN_RECORD) or {}).get('cancelled'):
+        # the dropped shards of a cancelled run have no output
+        keys = existing_outputs(resultsbucket_name, f'{project}/results/{run_id}/', keys)
+    if not keys:
+        inputs = keys
+        print(f"Merge group {group} of run {run_id} has no executed shards")
+    elif MERGE_MODE == 'streaming':
+        os.makedirs(f'{group_dir}/partial', exist_ok=True)
+        inputs = keys
+        with timer('Merge'):
+            merge_outputs(s3_bodies(resultsbucket_name, keys), f'{group_dir}/partial/{partial}', MERGE_KEYWORD_DEPTH)
+    else:
+        with timer('Download'):
+            inputs = download_files(resultsbucket_name, keys, group_dir)
+        with timer('Merge'):
+            rebot_cli([f"--outputdir={group_dir}/partial", f"--output={partial}", "--log=NONE", "--report=NONE", "--merge", "--nostatusrc", *inputs], exit=False)
+    if keys:
+        with timer('Upload'):
+            s3_client().upload_file(f'{group_dir}/partial/{partial}', resultsbucket_name, f'{project}/results/{run_id}/partials/{partial}')
+    shutil.rmtree(group_dir, ignore_errors=True)
+    print(f"Merged {len(inputs)} shards of merge group {group} of run {run_id}")
+    # Lambda retries asynchronous invocations, a group is only counted once
+    if not claim(test_run_table, run_id, group_record(group), 'merged'):
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f'Merge group {group} was already merged')
+        }
+    run_record = increment(test_run_table, run_id, RUN_RECORD, 'merged_groups')
+    if run_record['merged_groups'] == run_record['groups']:
+        return merge_run(test_run_table, resultsbucket_name, project, run_id, from_partials=True)
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Merge group {group} of run {run_id} merged')
+    }
+
+
+def merge_run(test_run_table, resultsbucket_name, project, run_id, from_partials=False):
+    """
+    Merge the results of a run into the final output.xml, log.html and report.html
+    Only one invocation merges a run with a run record, e.g. the merge of its last merge group or a status request,
+    the others get 202 while the merge is running
+    Args:
+        from_partials: merge the partial results of the merge groups instead of the output of every shard
+    """
+    has_run_record = get_record(test_run_table, run_id, RUN_RECORD) is not None
+    if has_run_record and not claim(test_run_table, run_id, RUN_RECORD, 'final_merge', expires=FINAL_MERGE_CLAIM_SECONDS):
+        return {
+            'statusCode': 202,
+            'body': json.dumps('Run is being merged')
+        }
+    try:
+        return merge_final(test_run_table, resultsbucket_name, project, run_id, from_partials)
+    except Exception:
+        if has_run_record:
+            # the next status request or retry merges the run again
+            release(test_run_table, run_id, RUN_RECORD, 'final_merge')
+        raise
+
+
+def merge_final(test_run_table, resultsbucket_name, project, run_id, from_partials):
+    """Merge the results of a run, see merge_run"""
+    print(f"project: {project} testsuite: {run_id}")
+    run_dir = f'/tmp/{project}/results/{run_id}'
+    run_record = get_record(test_run_table, run_id, RUN_RECORD) or {}
+    prefix = f'{project}/results/{run_id}/partials/' if from_partials else f'{project}/results/{run_id}/'
+    keys = existing_outputs(resultsbucket_name, prefix)
+    if not keys:
+        # a run which was cancelled before any shard was executed has nothing to merge
+        set_test_run_status(test_run_table, run_id, "CANCELLED" if run_record.get('cancelled') else "MERGED")
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "run_id": run_id,
+                "tests_passed": 0,
+                "tests_failed": 0,
+                "tests_total": 0,
+                "cancelled": bool(run_record.get('cancelled', False)),
+                "cancel_reason": run_record.get('cancel_reason')
+            }),
+        }
+    rerun_of = run_record.get('rerun_of')
+    # the log and report of a rerun are built once its results are merged over the original run
+    reports = ["--log=NONE", "--report=NONE"] if rerun_of else ["--log=log.html", "--report=report.html"]
+    if MERGE_MODE == 'streaming':
+        # the outputs are parsed straight from their S3 responses, only the merged output is written to /tmp
+        os.makedirs(f'{run_dir}/final', exist_ok=True)
+        with timer('Merge'):
+            summary = merge_outputs(s3_bodies(resultsbucket_name, keys), f'{run_dir}/final/output.xml', MERGE_KEYWORD_DEPTH)
+        if not rerun_of:
+            with timer('Report'):
+                rebot_cli([f"--outputdir={run_dir}/final", "--output=NONE", *reports, "--nostatusrc", f'{run_dir}/final/output.xml'], exit=False)
+        tests_passed, tests_failed, tests_total = summary['passed'], summary['failed'], summary['total']
+        durations = summary['durations']
+    else:
         print('Downloading results folder from s3 bucket to tmp')
-        print(f"project: {project} testsuite: {run_id}")
-        # Download project folder from s3 bucket to tmp
-        download_s3_folder(resultsbucket_name, f'{project}/results/{run_id}', f'/tmp/{project}/results/{run_id}')
-        rebot_cli([f"--outputdir=/tmp/{project}/results/{run_id}/final", "--output=output.xml", "--log=log.html", "--report=report.html", "--merge", "--nostatusrc", f"/tmp/{project}/results/{run_id}/*.xml"], exit=False)
-        result = ExecutionResult(f'/tmp/{project}/results/{run_id}/final/output.xml')
-        set_test_run_status(test_run_table, run_id, "MERGED")
+        with timer('Download'):
+            if from_partials:
+                download_s3_folder(resultsbucket_name, f'{project}/results/{run_id}/partials/', f'{run_dir}/partials')
+                inputs = f'{run_dir}/partials/*.xml'
+            else:
+                # Download project folder from s3 bucket to tmp
+                download_s3_folder(resultsbucket_name, f'{project}/results/{run_id}', run_dir, exclude=('allure-results/', 'allure/', 'partials/', 'final/'))
+                inputs = f'{run_dir}/*.xml'
+        with timer('Merge'):
+            rebot_cli([f"--outputdir={run_dir}/final", "--output=output.xml", *reports, "--merge", "--nostatusrc", inputs], exit=False)
+            result = ExecutionResult(f'{run_dir}/final/output.xml')
         tests_passed = result.suite.statistics.passed
         tests_failed = result.suite.statistics.failed
         tests_total = result.suite.statistics.total
-        # Upload .xml file to s3 bucket
-        #s3.Bucket(resultsbucket_name).upload_file(f'/tmp/{project}/results/{run_id}/final/output.xml', f'{project}/results/{run_id}/final/output.xml')
-        upload_folder_to_s3(resultsbucket_name, f'{project}/results/{run_id}/final', f'/tmp/{project}/results/{run_id}/final')
-    # Delete tmp folder
-    shutil.rmtree('/tmp', ignore_errors=True)
+        durations = [(test.longname, test.status, test.elapsedtime / 1000) for test in result.suite.all_tests]
+    if not run_record.get('cancelled'):
+        # the tests a cancelled run did not get to say nothing about their duration
+        update_test_timings(resultsbucket_name, project, durations)
+    if rerun_of:
+        # the durations above are the ones of the executed tests only
+        merged_summary = merge_over_original(resultsbucket_name, project, rerun_of, run_dir)
+        tests_passed, tests_failed, tests_total = merged_summary['passed'], merged_summary['failed'], merged_summary['total']
+        set_run_summary(test_run_table, run_id, merged_summary)
+    with open(f'{run_dir}/final/metrics.json', 'w') as f:
+        json.dump(run_metrics(test_run_table, run_id, run_record), f)
+    # Upload .xml file to s3 bucket, the run is only MERGED once all files are uploaded
+    with timer('Upload'):
+        upload_s3_folder(resultsbucket_name, f'{project}/results/{run_id}/final', f'{run_dir}/final')
+    allure_archive = run_record.get('allure_archive', False)
+    if allure_archive:
+        combine_allure_results(resultsbucket_name, project, run_id)
+    set_test_run_status(test_run_table, run_id, "MERGED")
+    # Delete the results of the run, nothing else of the container is touched
+    shutil.rmtree(run_dir, ignore_errors=True)
     return {
         "statusCode": 200,
         "body": json.dumps({
@@ -97,30 +305,187 @@ def lambda_handler(event, context):
             "download_xml": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/final/output.xml",
             "download_log": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/final/log.html",
             "download_report": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/final/report.html",
-            "allure_results": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/allure-results"
-
+            "download_metrics": f"s3://{resultsbucket_name}.s3.amazonaws.com/{project}/results/{run_id}/final/metrics.json",
+            "allure_results": allure_results_link(resultsbucket_name, project, run_id, allure_archive),
+            "cancelled": bool(run_record.get('cancelled', False)),
+            "cancel_reason": run_record.get('cancel_reason'),
+            "rerun_of": rerun_of,
+            "content_version": run_record.get('content_version')
         }),
     }
 
-def download_s3_folder(bucket_name, s3_folder, local_dir=None):
+
+@timed('MergeOriginal')
+def merge_over_original(bucket_name, project, original_run_id, run_dir):
+    """
+    Merge the results of a rerun over the merged output of the original run with rebot --merge:
+    the re-executed tests replace the ones of the original run, all other tests are kept.
+    The merged output, log and report replace the ones of the rerun in {run_dir}/final
+    Returns:
+        dict with the passed, failed, skipped and total tests of the merged output and its failed tests,
+        only the first MAX_RUN_FAILED_TESTS failed tests are listed
+    """
+    original = f'{run_dir}/original.xml'
+    s3_client().download_file(bucket_name, f'{project}/results/{original_run_id}/final/output.xml', original)
+    os.replace(f'{run_dir}/final/output.xml', f'{run_dir}/rerun.xml')
+    rebot_cli([f"--outputdir={run_dir}/final", "--output=output.xml", "--log=log.html", "--report=report.html", "--merge", "--nostatusrc", original, f'{run_dir}/rerun.xml'], exit=False)
+    suite = ExecutionResult(f'{run_dir}/final/output.xml').suite
+    failed_tests = [test.longname for test in suite.all_tests if test.status == 'FAIL']
+    print(f"Merged the rerun over the results of run {original_run_id}")
+    return {'passed': suite.statistics.passed, 'failed': suite.statistics.failed, 'skipped': suite.statistics.skipped,
+            'total': suite.statistics.total, 'failed_tests': failed_tests[:MAX_RUN_FAILED_TESTS]}
+
+
+def set_run_summary(table, run_id, summary):
+    """
+    Store the statistics of a merged rerun in its run record,
+    status requests and the next rerun of the run read them instead of the merged output
+    """
+    try:
+        table.update_item(
+            Key={'run_id': run_id, 'job_id': RUN_RECORD},
+            UpdateExpression="set merged_summary=:s",
+            ExpressionAttributeValues={':s': summary})
+    except ClientError as err:
+        logger.error(
+            "Couldn't update the summary of test_run %s in table %s. Here's why: %s: %s",
+            run_id, table.name,
+            err.response['Error']['Code'], err.response['Error']['Message'])
+        raise
+
+
+def run_progress(table, run_id, since=None, wait=0, context=None):
+    """
+    Return the progress of a run: the status of every shard, the test counters and the first failed tests
+    Served from the run record and the progress record, without querying the jobs or reading any output.
+    Args:
+        since: the version of the progress the client knows, the request waits until the progress changes
+        wait: the longest wait in seconds, at most MAX_PROGRESS_WAIT
+        context: the Lambda context, the request does not wait longer than the invocation may run
+    """
+    deadline = time.monotonic() + min(wait, MAX_PROGRESS_WAIT)
+    if context is not None:
+        deadline = min(deadline, time.monotonic() + context.get_remaining_time_in_millis() / 1000 - 2)
+    while True:
+        progress = get_record(table, run_id, PROGRESS_RECORD)
+        if progress is None:
+            return {
+                'statusCode': 404,
+                'body': json.dumps(f'No progress of test run {run_id}')
+            }
+        done = progress.get('run_status') in ('MERGED', 'CANCELLED')
+        if since is None or int(progress['updates']) > since or done or time.monotonic() >= deadline:
+            break
+        time.sleep(PROGRESS_POLL_INTERVAL)
+    run_record = get_record(table, run_id, RUN_RECORD) or {}
+    shards = {number: plain(shard) for number, shard in progress.get('shards', {}).items()}
+    # the first failure of a running shard is reported by its listener, the others when the shard is executed
+    failed_tests = list(dict.fromkeys([*progress.get('first_failures', []), *progress.get('failed_tests', [])]))
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "run_id": run_id,
+            "run_status": progress.get('run_status'),
+            "version": int(progress['updates']),
+            "elapsed": round(time.time() - float(run_record['created_at']), 3) if 'created_at' in run_record else None,
+            "shards_total": plain(run_record.get('total_shards')),
+            "shards_completed": plain(run_record.get('completed_shards')),
+            "shards_running": sum(1 for shard in shards.values() if shard['status'] == 'IN_PROGRESS'),
+            "tests_executed": plain(run_record.get('tests_executed', 0)),
+            "tests_passed": plain(run_record.get('tests_passed', 0)),
+            "tests_failed": plain(run_record.get('tests_failed', 0)),
+            "tests_skipped": plain(run_record.get('tests_skipped', 0)),
+            "failed_tests": failed_tests,
+            "cancelled": bool(run_record.get('cancelled', False)),
+            "cancel_reason": run_record.get('cancel_reason'),
+            "shards": shards
+        })
+    }
+
+
+def plain(value):
+    """Convert the Decimal numbers of a DynamoDB item into int and float"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+def run_metrics(table, run_id, run_record):
+    """
+    Roll up the phase timings of a run: the phases of the distributor, of every shard and of this merge,
+    and per phase the total, minimum, maximum and mean over the shards
+    Returns:
+        dict which can be serialized as json
+    """
+    shards = []
+    missing = 0
+    for item in filter(is_job_item, query_run(table, run_id)):
+        if item.get('job_status') != 'CANCELLED' and 'phases' not in item:
+            missing += 1
+        shards.append({
+            'job_id': item['job_id'],
+            'shard_name': item.get('shard_name'),
+            'phases': {phase: float(seconds) for phase, seconds in item.get('phases', {}).items()},
+        })
+    if missing:
+        # the executor stores the phases with the summary of a shard, see set_test_job_summary
+        print(f"{missing} executed shards of run {run_id} have no phase timings")
+    rollup = {}
+    for phase in sorted({phase for shard in shards for phase in shard['phases']}):
+        values = [shard['phases'][phase] for shard in shards if phase in shard['phases']]
+        rollup[phase] = {'total': round(sum(values), 3), 'min': min(values), 'max': max(values),
+                         'mean': round(sum(values) / len(values), 3), 'shards': len(values)}
+    return {
+        'run_id': run_id,
+        'distributor': {phase: float(seconds) for phase, seconds in run_record.get('distributor_phases', {}).items()},
+        'shards': shards,
+        'phases': rollup,
+        'shards_without_phases': missing,
+        'merger': phases(),
+    }
+
+
+@timed('CombineAllure')
+def combine_allure_results(bucket_name, project, run_id):
+    """
+    Combine the Allure results archives of all shards of a run into allure-results.tar.gz,
+    in one streaming pass without writing the results to /tmp
+    Returns:
+        the number of files in the combined archive
     """
-    Download the contents of a folder directory
+    keys = sorted(obj['Key'] for obj in list_objects(bucket_name, f'{project}/results/{run_id}/allure/'))
+    files = combine_bundles(bucket_name, keys, f'{project}/results/{run_id}/allure-results.tar.gz')
+    print(f"Combined {files} Allure results of {len(keys)} shards of run {run_id}")
+    return files
+
+
+def existing_outputs(bucket_name, prefix, keys=None):
+    """
+    List the output files directly below a prefix, e.g. the shard outputs or the partial results of a run
     Args:
-        bucket_name: the name of the s3 bucket
-        s3_folder: the folder path in the s3 bucket
-        local_dir: a relative or absolute directory path in the local file system
+        keys: only return these keys, if they exist
+    Returns:
+        the sorted keys
     """
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucket_name)
-    for obj in bucket.objects.filter(Prefix=s3_folder):
-        target = obj.key if local_dir is None \
-            else os.path.join(local_dir, os.path.relpath(obj.key, s3_folder))
-        if not target.startswith(f"{s3_folder}/allure-results/"):
-            if not os.path.exists(os.path.dirname(target)):
-                os.makedirs(os.path.dirname(target))
-            if obj.key[-1] == '/':
-                continue
-            bucket.download_file(obj.key, target)
+    found = {obj['Key'] for obj in list_objects(bucket_name, prefix)
+             if obj['Key'].endswith('.xml') and '/' not in obj['Key'][len(prefix):]}
+    return sorted(found if keys is None else found.intersection(keys))
+
+
+def s3_bodies(bucket_name, keys):
+    """Yield the response body of every object, the next request is only sent once the previous body is read"""
+    for key in keys:
+        yield s3_client().get_object(Bucket=bucket_name, Key=key)['Body']
+
+
+def allure_results_link(bucket_name, project, run_id, archived):
+    if archived:
+        return f"s3://{bucket_name}.s3.amazonaws.com/{project}/results/{run_id}/allure-results.tar.gz"
+    return f"s3://{bucket_name}.s3.amazonaws.com/{project}/results/{run_id}/allure-results"
 
 def print_all_files_and_folders_recursively(path):
     for root, dirs, files in os.walk(path):
@@ -131,75 +496,124 @@ def print_all_files_and_folders_recursively(path):
         for f in files:
             print('{}{}'.format(subindent, f))
 
-def upload_folder_to_s3(bucket_name, s3_folder, local_dir):
+@timed('UpdateTimings')
+def update_test_timings(bucket_name, project, durations, smoothing=0.5):
     """
-    Upload the contents of a folder directory
+    Fold the test durations of a merged run into the timing history of the project
+    The distributor uses the history to balance the shards by duration.
+    The file is only written if no other merge of the project wrote it since it was read, otherwise it is read again.
     Args:
-        bucket_name: the name of the s3 bucket
-        s3_folder: the folder path in the s3 bucket
-        local_dir: a relative or absolute directory path in the local file system
+        bucket_name: the name of the s3 results bucket
+        project: the project folder in the s3 bucket
+        durations: (longname, status, seconds) of every test of the merged run
+        smoothing: weight of the new duration against the known one
     """
     client = boto3.client('s3')
+    key = f'{project}/timings.json'
+    for attempt in range(TIMINGS_RETRIES):
+        try:
+            response = client.get_object(Bucket=bucket_name, Key=key)
+            condition = {'IfMatch': response['ETag']}
+            history = json.loads(response['Body'].read())
+        except client.exceptions.NoSuchKey:
+            condition = {'IfNoneMatch': '*'}
+            history = {}
+        history = fold_timings(history, durations, smoothing, TIMINGS_MAX_AGE)
+        try:
+            client.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(history, separators=(',', ':')), **condition)
+            return
+        except ClientError as err:
+            # 412 if the file changed since it was read, 409 if another write of it is in progress
+            if err.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    logger.error("Couldn't update the test timings of project %s, it was changed by %s concurrent merges", project, TIMINGS_RETRIES)
 
-    # enumerate local files recursively
-    for root, dirs, files in os.walk(local_dir):
 
-        for filename in files:
-
-            # construct the full local path
-            local_path = os.path.join(root, filename)
-
-            # construct the full Dropbox path
-            relative_path = os.path.relpath(local_path, local_dir)
-            s3_path = os.path.join(s3_folder, relative_path)
-
-            # relative_path = os.path.relpath(os.path.join(root, filename))
-
-            print(f'Searching {s3_path} in {bucket_name}')
-            try:
-                client.head_object(Bucket=bucket_name, Key=s3_path)
-                print(f"Path found on S3! Skipping {s3_path}")
+def fold_timings(history, durations, smoothing, max_age):
+    """
+    Add the durations of a run to the timing history of a project
+    Tests which were not executed in the last max_age runs are dropped, e.g. deleted or renamed tests
+    Args:
+        history: {"runs": 12, "durations": {"Tests.Suite.Test": 1.5}, "last_run": {"Tests.Suite.Test": 12}},
+            a flat dict of durations is a history of files written before the runs were counted
+    Returns:
+        the new history
+    """
+    if 'runs' not in history:
+        history = {'runs': 0, 'durations': history, 'last_run': {longname: 0 for longname in history}}
+    run = history['runs'] + 1
+    timings, last_run = history['durations'], history['last_run']
+    for longname, status, duration in durations:
+        # skipped and not run tests say nothing about the duration of a test
+        if status not in ('PASS', 'FAIL'):
+            continue
+        known = timings.get(longname)
+        timings[longname] = round(duration if known is None else smoothing * duration + (1 - smoothing) * known, 3)
+        last_run[longname] = run
+    for longname in [longname for longname, seen in last_run.items() if run - seen >= max_age]:
+        del timings[longname], last_run[longname]
+    history['runs'] = run
+    return history
 
-                # try:
-                    # client.delete_object(Bucket=bucket, Key=s3_path)
-                # except:
-                    # print "Unable to delete %s..." % s3_path
-            except:
-                print("Uploading {s3_path}...")
-                client.upload_file(local_path, bucket_name, s3_path)
 
+def run_summary(table, run_id, run_record):
+    """
+    The statistics of a run from the counters the executors added to its run record,
+    without reading the items of the jobs
+    Returns:
+        dict with passed, failed, skipped and total tests and the first failed tests from the progress record,
+        None for runs without counters
+    """
+    if 'tests_passed' not in run_record:
+        return None
+    progress = get_record(table, run_id, PROGRESS_RECORD) or {}
+    return {'passed': int(run_record['tests_passed']), 'failed': int(run_record['tests_failed']),
+            'skipped': int(run_record['tests_skipped']), 'total': int(run_record['tests_executed']),
+            'failed_tests': list(progress.get('failed_tests', []))}
 
-def is_run_executed(table, run_id):
-    try:
-        response = table.query(KeyConditionExpression=Key('run_id').eq(run_id))
-    except ClientError as err:
-        logger.error(
-            "Couldn't query for test_runs with run_id in %s. Here's why: %s: %s", run_id,
-            err.response['Error']['Code'], err.response['Error']['Message'])
-        raise
-    else:
-        # If all items in response['Items'] have item['job_status'] == COMPLETED, return True
-        # Otherwise, return False
-        return all(item['job_status'] == 'EXECUTED' for item in response['Items'])
 
 def is_run_merged(table, run_id):
     try:
-        response = table.query(KeyConditionExpression=Key('run_id').eq(run_id))
+        run_record = get_record(table, run_id, RUN_RECORD)
+        if run_record is not None:
+            return run_record.get('run_status') == 'MERGED'
+        # runs created before the run record existed
+        items = [item for item in query_run(table, run_id) if is_job_item(item)]
     except ClientError as err:
         logger.error(
             "Couldn't query for test_runs with run_id in %s. Here's why: %s: %s", run_id,
             err.response['Error']['Code'], err.response['Error']['Message'])
         raise
     else:
-        # If all items in response['Items'] have item['job_status'] == MERGED, return True
+        # If all job items have item['job_status'] == MERGED, return True
         # Otherwise, return False
-        return all(item['job_status'] == 'MERGED' for item in response['Items'])
+        return all(item['job_status'] == 'MERGED' for item in items)
 
 
 def set_test_run_status(table, run_id, run_status):
     try:
-        test_jobs = table.query(KeyConditionExpression=Key('run_id').eq(run_id))
-        for item in test_jobs['Items']:
+        if get_record(table, run_id, RUN_RECORD) is not None:
+            table.update_item(
+                Key={'run_id': run_id, 'job_id': RUN_RECORD},
+                UpdateExpression="set run_status=:s",
+                ExpressionAttributeValues={
+                    ':s': run_status})
+            try:
+                # wakes up the clients which wait for the next change of the progress
+                table.update_item(
+                    Key={'run_id': run_id, 'job_id': PROGRESS_RECORD},
+                    UpdateExpression="set run_status=:s ADD updates :one",
+                    ConditionExpression="attribute_exists(run_id)",
+                    ExpressionAttributeValues={
+                        ':s': run_status, ':one': 1})
+            except ClientError as err:
+                # runs created before the progress record existed
+                if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+            return
+        # runs created before the run record existed
+        for item in [item for item in query_run(table, run_id) if is_job_item(item)]:
             response = table.update_item(
                 Key={'run_id': run_id, 'job_id': item['job_id']},
                 UpdateExpression="set job_status=:s",
@@ -210,4 +624,4 @@ def set_test_run_status(table, run_id, run_status):
         logger.error(
             "Couldn't update test_run %s, in table %s. Here's why: %s: %s",
             run_id, table.name,
-            err.response['Error']['Code'], err.response['Error']['Message'])
\ No newline at end of file
+            err.response['Error']['Code'], err.response['Error']['Message'])
@@ -0,0 +1,290 @@
+"""
+Merge Robot Framework output.xml files with bounded memory
+
+rebot builds the result model of all outputs in memory, including every keyword and message.
+merge_outputs reads the outputs one element at a time instead:
+
+- keywords and control structures nested deeper than keyword_depth are dropped while they are parsed,
+  like rebot's --removekeywords
+- every test is serialized to a spool file as soon as it is parsed, only the suite tree,
+  the positions of the tests in the spool file and the statistics stay in memory
+- suites with the same name below the same parent are merged, like rebot --merge combines the outputs of shards
+- the merged output.xml is written suite by suite from the spool file
+
+The output has the same structure as a rebot output (schema of the first input),
+statistics and suite statuses are computed from the merged tests.
+"""
+import datetime
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+# Elements which count as one keyword level, the content of a test or suite is made of them
+BODY_TAGS = {'kw', 'for', 'iter', 'while', 'if', 'branch', 'try', 'group', 'var', 'variable',
+             'return', 'break', 'continue', 'error'}
+# Format of the starttime and endtime of outputs before Robot Framework 7
+LEGACY_TIME_FORMAT = '%Y%m%d %H:%M:%S.%f'
+
+
+class SuiteNode:
+    """A suite of the merged output, its tests are stored in the spool file"""
+    __slots__ = ('name', 'attributes', 'suites', 'tests', 'setup', 'teardown', 'doc', 'meta',
+                 'statuses', 'start', 'end', 'legacy_times', 'passed', 'failed', 'skipped')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.suites = {}
+        # (offset, length) of the serialized tests in the spool file
+        self.tests = []
+        self.setup = self.teardown = self.doc = None
+        self.meta = []
+        self.statuses = set()
+        self.start = self.end = None
+        self.legacy_times = False
+        self.passed = self.failed = self.skipped = 0
+
+    def child(self, name, attributes):
+        if name not in self.suites:
+            self.suites[name] = SuiteNode(name, attributes)
+        return self.suites[name]
+
+    def add_status(self, status):
+        self.statuses.add(status.get('status'))
+        start, end = status_times(status)
+        if 'starttime' in status.attrib:
+            self.legacy_times = True
+        if start is not None and (self.start is None or start < self.start):
+            self.start = start
+        if end is not None and (self.end is None or end > self.end):
+            self.end = end
+
+
+def status_times(status):
+    """Return the start and end of a status element as datetimes, None if unknown"""
+    if 'start' in status.attrib:
+        start = datetime.datetime.fromisoformat(status.get('start'))
+        return start, start + datetime.timedelta(seconds=float(status.get('elapsed', 0)))
+    times = []
+    for name in ('starttime', 'endtime'):
+        value = status.get(name)
+        times.append(datetime.datetime.strptime(value, LEGACY_TIME_FORMAT) if value and value != 'N/A' else None)
+    return tuple(times)
+
+
+def elapsed_seconds(status):
+    start, end = status_times(status)
+    return (end - start).total_seconds() if start and end else 0.0
+
+
+def merge_outputs(sources, output, keyword_depth=None):
+    """
+    Merge output.xml files into one output.xml
+    Args:
+        sources: file objects or paths of the outputs, e.g. the bodies of S3 get_object responses
+        output: the path of the merged output.xml
+        keyword_depth: the number of keyword levels kept below tests and suites, None keeps all keywords
+    Returns:
+        dict with the passed, failed, skipped and total tests and the durations of the tests
+        as a list of (longname, status, seconds)
+    """
+    root = SuiteNode(None, {})
+    tags = {}
+    durations = []
+    robot_attributes = None
+    with tempfile.TemporaryFile() as spool, tempfile.TemporaryFile() as errors:
+        for source in sources:
+            attributes = parse_output(source, root, spool, errors, tags, durations, keyword_depth)
+            robot_attributes = robot_attributes or attributes
+        write_output(output, root, spool, errors, tags, robot_attributes or {})
+    total = {'passed': root.passed, 'failed': root.failed, 'skipped': root.skipped}
+    total['total'] = sum(total.values())
+    total['durations'] = durations
+    return total
+
+
+def parse_output(source, root, spool, errors, tags, durations, keyword_depth):
+    """Fold one output.xml into the suite tree, its tests into the spool file and its errors into the errors file"""
+    # elements from the root to the current element and the suites among them
+    elements = []
+    suites = [root]
+    depth = 0
+    robot_attributes = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'robot':
+                robot_attributes = dict(elem.attrib)
+            elif elem.tag == 'suite' and is_result_suite(elements):
+                suites.append(suites[-1].child(elem.get('name'), {key: value for key, value in elem.attrib.items() if key != 'id'}))
+            elif elem.tag in BODY_TAGS:
+                depth += 1
+            elements.append(elem)
+            continue
+        elements.pop()
+        parent = elements[-1] if elements else None
+        if elem.tag in BODY_TAGS:
+            depth -= 1
+            if keyword_depth is not None and depth >= keyword_depth:
+                # too deep, the parent keyword is kept without its content
+                parent.remove(elem)
+                continue
+        elif elem.tag == 'msg' and keyword_depth is not None and depth > keyword_depth:
+            # the message belongs to a keyword which is removed, free it right away
+            parent.remove(elem)
+            continue
+        elif elem.tag == 'suite' and is_result_suite(elements):
+            suites.pop()
+        if parent is None or parent.tag != 'suite' or not is_result_suite(elements[:-1]):
+            if parent is not None and parent.tag == 'errors' and elem.tag == 'msg':
+                errors.write(serialize(elem) + b'\n')
+                parent.remove(elem)
+            elif parent is not None and parent.tag in ('statistics', 'robot'):
+                parent.remove(elem)
+            continue
+        # direct children of a suite
+        node = suites[-1]
+        if elem.tag == 'test':
+            add_test(node, suites, elem, spool, tags, durations)
+        elif elem.tag == 'kw':
+            if elem.get('type', '').upper() == 'TEARDOWN':
+                node.teardown = node.teardown or serialize(elem)
+            else:
+                node.setup = node.setup or serialize(elem)
+        elif elem.tag == 'doc':
+            node.doc = node.doc if node.doc is not None else serialize(elem)
+        elif elem.tag == 'meta':
+            if not any(meta_name == elem.get('name') for meta_name, _ in node.meta):
+                node.meta.append((elem.get('name'), serialize(elem)))
+        elif elem.tag == 'status':
+            node.add_status(elem)
+        # the element is written, free its memory
+        parent.remove(elem)
+    return robot_attributes
+
+
+def is_result_suite(ancestors):
+    """
+    True if a suite element with these ancestors is a suite of the results,
+    the suite statistics below <statistics> are suite elements too
+    """
+    return not ancestors or ancestors[-1].tag in ('robot', 'suite')
+
+
+def add_test(node, suites, test, spool, tags, durations):
+    status = test.find('status')
+    result = status.get('status') if status is not None else 'FAIL'
+    if result == 'PASS':
+        counter = 'passed'
+    elif result == 'SKIP':
+        counter = 'skipped'
+    else:
+        counter = 'failed'
+    # the counts of every suite include the tests of its child suites
+    for suite in suites:
+        setattr(suite, counter, getattr(suite, counter) + 1)
+    for tag in test.findall('tag'):
+        stat = tags.setdefault(tag.text, {'passed': 0, 'failed': 0, 'skipped': 0})
+        stat[counter] += 1
+    longname = '.'.join([suite.name for suite in suites[1:]] + [test.get('name')])
+    durations.append((longname, result, elapsed_seconds(status) if status is not None else 0.0))
+    # the id depends on the position in the merged tree, it is written by write_suite
+    test.attrib.pop('id', None)
+    data = serialize(test)
+    spool.seek(0, 2)
+    node.tests.append((spool.tell(), len(data)))
+    spool.write(data)
+
+
+def serialize(elem):
+    elem.tail = None
+    return ET.tostring(elem, encoding='utf-8', xml_declaration=False)
+
+
+def write_output(path, root, spool, errors, tags, robot_attributes):
+    top_suites = list(root.suites.values())
+    if len(top_suites) == 1:
+        top = top_suites[0]
+    else:
+        # outputs of different top level suites are combined like rebot does without --merge
+        top = SuiteNode(' & '.join(suite.name for suite in top_suites), {})
+        top.suites = root.suites
+        for suite in top_suites:
+            top.statuses |= suite.statuses
+            top.legacy_times = top.legacy_times or suite.legacy_times
+        for time, pick in (('start', min), ('end', max)):
+            values = [getattr(suite, time) for suite in top_suites if getattr(suite, time) is not None]
+            setattr(top, time, pick(values) if values else None)
+        top.passed, top.failed, top.skipped = root.passed, root.failed, root.skipped
+    with open(path, 'wb') as out:
+        out.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write(f'<robot{format_attributes(robot_attributes)}>\n'.encode())
+        suite_stats = []
+        write_suite(out, top, 's1', (), spool, suite_stats)
+        out.write(b'<statistics>\n<total>\n')
+        write_stat(out, top, 'All Tests')
+        out.write(b'</total>\n<tag>\n')
+        for tag, stat in sorted(tags.items()):
+            write_stat(out, SimpleStat(stat), tag)
+        out.write(b'</tag>\n<suite>\n')
+        for suite_id, longname, node in suite_stats:
+            write_stat(out, node, longname, {'id': suite_id, 'name': node.name})
+        out.write(b'</suite>\n</statistics>\n<errors>\n')
+        errors.seek(0)
+        shutil.copyfileobj(errors, out)
+        out.write(b'</errors>\n</robot>\n')
+
+
+class SimpleStat:
+    __slots__ = ('passed', 'failed', 'skipped')
+
+    def __init__(self, stat):
+        self.passed, self.failed, self.skipped = stat['passed'], stat['failed'], stat['skipped']
+
+
+def write_suite(out, node, suite_id, parents, spool, suite_stats):
+    longname = '.'.join(parents + (node.name,))
+    suite_stats.append((suite_id, longname, node))
+    out.write(f'<suite{format_attributes({"id": suite_id, **node.attributes})}>\n'.encode())
+    if node.setup:
+        out.write(node.setup + b'\n')
+    for index, child in enumerate(node.suites.values(), start=1):
+        write_suite(out, child, f'{suite_id}-s{index}', parents + (node.name,), spool, suite_stats)
+    for index, (offset, length) in enumerate(node.tests, start=1):
+        spool.seek(offset)
+        data = spool.read(length)
+        # data starts with '<test', the id goes first like in the outputs of Robot Framework
+        out.write(f'<test id="{suite_id}-t{index}"'.encode() + data[len(b'<test'):] + b'\n')
+    if node.teardown:
+        out.write(node.teardown + b'\n')
+    if node.doc is not None:
+        out.write(node.doc + b'\n')
+    for _, meta in node.meta:
+        out.write(meta + b'\n')
+    out.write(f'<status{format_attributes(suite_status(node))}/>\n'.encode())
+    out.write(b'</suite>\n')
+
+
+def suite_status(node):
+    if 'FAIL' in node.statuses or node.failed:
+        status = {'status': 'FAIL'}
+    elif 'PASS' in node.statuses or node.passed:
+        status = {'status': 'PASS'}
+    else:
+        status = {'status': 'SKIP'}
+    if node.legacy_times:
+        status['starttime'] = node.start.strftime(LEGACY_TIME_FORMAT)[:-3] if node.start else 'N/A'
+        status['endtime'] = node.end.strftime(LEGACY_TIME_FORMAT)[:-3] if node.end else 'N/A'
+    elif node.start is not None:
+        status['start'] = node.start.isoformat(timespec='microseconds')
+        status['elapsed'] = f'{(node.end - node.start).total_seconds():.6f}'
+    return status
+
+
+def write_stat(out, stat, text, attributes=None):
+    counts = {'pass': stat.passed, 'fail': stat.failed, 'skip': stat.skipped}
+    out.write(f'<stat{format_attributes({**counts, **(attributes or {})})}>{escape(text)}</stat>\n'.encode())
+
+
+def format_attributes(attributes):
+    return ''.join(f' {name}={quoteattr(str(value))}' for name, value in attributes.items())
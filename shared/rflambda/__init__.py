@@ -0,0 +1 @@
+"""Modules shared by the distributor, executor and merger Lambda functions"""
@@ -0,0 +1,138 @@
+import os
+import tarfile
+import tempfile
+from botocore.exceptions import ClientError
+from rflambda.metrics import count
+from rflambda.transfer import s3_client
+
+
+def bundle_exists(bucket_name, key):
+    try:
+        s3_client().head_object(Bucket=bucket_name, Key=key)
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
+    return True
+
+
+def upload_bundle(bucket_name, key, local_dir):
+    """
+    Pack the contents of a folder into a gzip compressed tar archive and upload it
+    Args:
+        bucket_name: the name of the s3 bucket
+        key: the key of the archive in the s3 bucket
+        local_dir: a relative or absolute directory path in the local file system
+    Returns:
+        the size of the archive in bytes
+    """
+    with tempfile.NamedTemporaryFile(suffix='.tar.gz') as archive:
+        with tarfile.open(fileobj=archive, mode='w:gz', compresslevel=6) as tar:
+            for root, dirs, files in os.walk(local_dir):
+                # sorted, so the same content results in the same archive layout
+                dirs.sort()
+                for filename in sorted(files):
+                    local_path = os.path.join(root, filename)
+                    tar.add(local_path, arcname=os.path.relpath(local_path, local_dir), recursive=False)
+        archive.flush()
+        s3_client().upload_file(archive.name, bucket_name, key)
+        count('S3UploadObjects')
+        count('S3UploadBytes', os.path.getsize(archive.name))
+        return os.path.getsize(archive.name)
+
+
+def extract_bundle(bucket_name, key, local_dir):
+    """
+    Download and extract an archive created by upload_bundle in one streaming pass,
+    the archive itself is never written to disk
+    Args:
+        bucket_name: the name of the s3 bucket
+        key: the key of the archive in the s3 bucket
+        local_dir: a relative or absolute directory path in the local file system
+    Returns:
+        the size of the archive in bytes
+    """
+    response = s3_client().get_object(Bucket=bucket_name, Key=key)
+    root = os.path.realpath(local_dir)
+    os.makedirs(root, exist_ok=True)
+    with tarfile.open(fileobj=response['Body'], mode='r|gz') as tar:
+        for member in tar:
+            target = os.path.realpath(os.path.join(root, member.name))
+            if not (member.isfile() or member.isdir()) or os.path.commonpath([root, target]) != root:
+                raise ValueError(f"Refusing to extract {member.name} from {key}")
+            tar.extract(member, root)
+    count('S3DownloadObjects')
+    count('S3DownloadBytes', response['ContentLength'])
+    return response['ContentLength']
+
+
+class S3MultipartWriter:
+    """
+    Write-only file object which uploads everything written to it as one S3 object,
+    in parts of part_size bytes, so no local copy of the object is needed
+    """
+    # S3 accepts parts from 5 MB, except for the last one
+    def __init__(self, bucket_name, key, part_size=8 * 1024 * 1024):
+        self.client = s3_client()
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = self.client.create_multipart_upload(Bucket=bucket_name, Key=key)['UploadId']
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, data):
+        count('S3UploadBytes', len(data))
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=data)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+        count('S3UploadObjects')
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+
+
+def combine_bundles(bucket_name, keys, target_key):
+    """
+    Combine archives created by upload_bundle into one archive in one streaming pass:
+    every archive is read from its GET response and written to a multipart upload
+    Args:
+        bucket_name: the name of the s3 bucket
+        keys: the keys of the archives
+        target_key: the key of the combined archive
+    Returns:
+        the number of files in the combined archive
+    """
+    writer = S3MultipartWriter(bucket_name, target_key)
+    files = 0
+    try:
+        with tarfile.open(fileobj=writer, mode='w|gz', compresslevel=6) as combined:
+            for key in keys:
+                response = s3_client().get_object(Bucket=bucket_name, Key=key)
+                count('S3DownloadObjects')
+                count('S3DownloadBytes', response['ContentLength'])
+                with tarfile.open(fileobj=response['Body'], mode='r|gz') as tar:
+                    for member in tar:
+                        if member.isfile():
+                            combined.addfile(member, tar.extractfile(member))
+                            files += 1
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return files
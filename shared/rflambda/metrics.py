@@ -0,0 +1,175 @@
+"""
+Phase timings and counters of the Lambda functions
+
+A Metrics object collects the time spent in every phase of one unit of work, e.g. an invocation
+of the distributor or one shard of the executor, and counters like the objects and bytes transferred from S3.
+emit() prints them as one JSON line in the CloudWatch embedded metric format (EMF),
+so CloudWatch extracts the metrics from the logs without any API call:
+
+    with Metrics('executor', run_id=run_id).activate() as metrics:
+        with timer('download'):
+            ...
+        count('S3DownloadBytes', size)
+        metrics.emit()
+
+timer and count use the Metrics activated in the current thread and do nothing without one,
+so shared code like rflambda.transfer can be instrumented without passing a Metrics object around.
+"""
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get('MetricsNamespace', 'RobotFrameworkLambda')
+
+_current = contextvars.ContextVar('rflambda_metrics', default=None)
+# The first Metrics of a container belongs to its cold start
+_cold_start = True
+_cold_start_lock = threading.Lock()
+
+
+def take_cold_start():
+    """True for the first call in a Lambda container, False afterwards"""
+    global _cold_start
+    with _cold_start_lock:
+        cold_start, _cold_start = _cold_start, False
+        return cold_start
+
+
+class Metrics:
+    """The phase timings and counters of one unit of work"""
+
+    def __init__(self, function, **properties):
+        """
+        Args:
+            function: the name of the function, the only dimension of the metrics
+            properties: logged with the metrics, e.g. the run_id, not used as dimensions
+        """
+        self.function = function
+        self.properties = properties
+        self.phases = {}
+        self.counters = {}
+        self.cold_start = take_cold_start()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        """Make this the Metrics of timer and count in the current thread"""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    @contextmanager
+    def timer(self, phase):
+        """Add the time spent in the block to a phase, also if the block raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def rounded_phases(self):
+        """The phases in seconds, rounded to milliseconds"""
+        with self._lock:
+            return {phase: round(seconds, 3) for phase, seconds in self.phases.items()}
+
+    def to_emf(self):
+        with self._lock:
+            phases, counters = dict(self.phases), dict(self.counters)
+        values = {f'{phase}Time': round(seconds * 1000, 1) for phase, seconds in phases.items()}
+        definitions = [{'Name': name, 'Unit': 'Milliseconds'} for name in values]
+        for name, value in counters.items():
+            values[name] = value
+            definitions.append({'Name': name, 'Unit': 'Bytes' if name.endswith('Bytes') else 'Count'})
+        values['ColdStart'] = int(self.cold_start)
+        definitions.append({'Name': 'ColdStart', 'Unit': 'Count'})
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{'Namespace': NAMESPACE, 'Dimensions': [['function']], 'Metrics': definitions}],
+            },
+            'function': self.function,
+            **{key: value for key, value in self.properties.items() if value is not None},
+            **values,
+        }
+
+    def emit(self):
+        """Print the metrics as one EMF JSON line and return them"""
+        document = self.to_emf()
+        print(json.dumps(document, default=str))
+        return document
+
+
+def current():
+    """The Metrics activated in the current thread, None if there is none"""
+    return _current.get()
+
+
+def instrument(function_name):
+    """Decorator for a lambda_handler, every invocation collects its own Metrics and emits them when it returns"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            metrics = Metrics(function_name)
+            with metrics.activate():
+                try:
+                    return handler(*args, **kwargs)
+                finally:
+                    metrics.emit()
+        return wrapper
+    return decorator
+
+
+def annotate(**properties):
+    """Add properties to the current Metrics, e.g. the run_id once it is known"""
+    metrics = current()
+    if metrics is not None:
+        metrics.properties.update(properties)
+
+
+def phases():
+    """The phases of the current Metrics in seconds, empty without one"""
+    metrics = current()
+    return metrics.rounded_phases() if metrics is not None else {}
+
+
+@contextmanager
+def timer(phase):
+    """Time a block as a phase of the current Metrics"""
+    metrics = current()
+    if metrics is None:
+        yield
+        return
+    with metrics.timer(phase):
+        yield
+
+
+def timed(phase):
+    """Decorator which times every call of a function as a phase of the current Metrics"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    """Add to a counter of the current Metrics, e.g. count('S3DownloadBytes', size)"""
+    metrics = current()
+    if metrics is not None:
+        metrics.count(name, value)
@@ -0,0 +1,258 @@
+"""
+Run level records in the TestRunTable
+
+Besides one item per job, a run has bookkeeping items in the TestRunTable.
+Their job_id starts with '#', so they never collide with the uuid job ids:
+
+- '#run': the run record, the number of shards and how many of them are executed,
+  the number of merge groups and how many of them are merged and the run_status,
+  the executed and failed tests, the failure threshold of the run and if the run is cancelled
+- '#group-00000': one record per merge group, the jobs of the group and how many of them are executed
+- '#progress': the progress of the run for the progress view of the merger, the status of every shard,
+  the first failed tests and a counter of the updates, so clients can wait for the next change
+"""
+import logging
+import time
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+RUN_RECORD = '#run'
+PROGRESS_RECORD = '#progress'
+
+
+def group_record(group):
+    return f'#group-{int(group):05d}'
+
+
+def is_job_item(item):
+    """True for the items of jobs, False for the bookkeeping items of a run"""
+    return not item['job_id'].startswith('#')
+
+
+def get_record(table, run_id, record_id):
+    """Return a bookkeeping item of a run, None if it does not exist"""
+    response = table.get_item(Key={'run_id': run_id, 'job_id': record_id}, ConsistentRead=True)
+    return response.get('Item')
+
+
+def query_run(table, run_id):
+    """Yield all items of a run, page by page"""
+    arguments = {'KeyConditionExpression': Key('run_id').eq(run_id)}
+    while True:
+        response = table.query(**arguments)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def is_run_executed(table, run_id):
+    """
+    True if all shards of the run are executed
+    Reads the counter of the run record, runs without a run record are checked job by job
+    """
+    run_record = get_record(table, run_id, RUN_RECORD)
+    if run_record is not None and 'total_shards' in run_record:
+        return run_record.get('completed_shards', 0) >= run_record['total_shards']
+    return all(item['job_status'] == 'EXECUTED' for item in query_run(table, run_id) if is_job_item(item))
+
+
+def increment(table, run_id, record_id, counter, amount=1):
+    """
+    Atomically add to a counter of a bookkeeping item
+    Every caller gets a different value back, so exactly one caller sees a counter reach its total
+    Returns:
+        the whole item after the update
+    Raises:
+        ClientError with the code ConditionalCheckFailedException if the item does not exist
+    """
+    return add_counters(table, run_id, record_id, {counter: amount})
+
+
+def add_counters(table, run_id, record_id, amounts):
+    """
+    Atomically add to several counters of a bookkeeping item in one request
+    Args:
+        amounts: dict of counter name to the amount which is added
+    Returns:
+        the whole item after the update
+    Raises:
+        ClientError with the code ConditionalCheckFailedException if the item does not exist
+    """
+    names = {f'#c{number}': counter for number, counter in enumerate(amounts)}
+    values = {f':a{number}': amount for number, amount in enumerate(amounts.values())}
+    response = table.update_item(
+        Key={'run_id': run_id, 'job_id': record_id},
+        UpdateExpression="ADD " + ", ".join(f'#c{number} :a{number}' for number in range(len(amounts))),
+        ConditionExpression="attribute_exists(run_id)",
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+        ReturnValues="ALL_NEW")
+    return response['Attributes']
+
+
+def count_job(table, run_id, job_id, status, counters=None, group=None):
+    """
+    Set the final status of a job and add it to the counters of its run record and merge group in one transaction,
+    so a job is counted exactly once, also when SQS delivers its message again or a failed attempt is retried
+    Args:
+        status: the final status of the job, e.g. EXECUTED
+        counters: dict of counter name of the run record to the amount which is added, None for runs without a run record
+        group: the merge group of the job, its completed counter is incremented
+    Returns:
+        False if the job is counted already, otherwise True
+    """
+    actions = [{'Update': {
+        'TableName': table.name,
+        'Key': {'run_id': run_id, 'job_id': job_id},
+        'UpdateExpression': "SET job_status = :status, counted = :true",
+        'ConditionExpression': "attribute_not_exists(counted)",
+        'ExpressionAttributeValues': {':status': status, ':true': True}}}]
+    if counters:
+        actions.append({'Update': {
+            'TableName': table.name,
+            'Key': {'run_id': run_id, 'job_id': RUN_RECORD},
+            'UpdateExpression': "ADD " + ", ".join(f'#c{number} :a{number}' for number in range(len(counters))),
+            'ConditionExpression': "attribute_exists(run_id)",
+            'ExpressionAttributeNames': {f'#c{number}': counter for number, counter in enumerate(counters)},
+            'ExpressionAttributeValues': {f':a{number}': amount for number, amount in enumerate(counters.values())}}})
+    if group is not None:
+        actions.append({'Update': {
+            'TableName': table.name,
+            'Key': {'run_id': run_id, 'job_id': group_record(group)},
+            'UpdateExpression': "ADD #completed :one",
+            'ConditionExpression': "attribute_exists(run_id)",
+            'ExpressionAttributeNames': {'#completed': 'completed'},
+            'ExpressionAttributeValues': {':one': 1}}})
+    try:
+        # the client of a table resource takes python types like the table itself
+        table.meta.client.transact_write_items(TransactItems=actions)
+    except ClientError as err:
+        reasons = err.response.get('CancellationReasons') or [{}]
+        if err.response['Error']['Code'] == 'TransactionCanceledException' and reasons[0].get('Code') == 'ConditionalCheckFailed':
+            return False
+        raise
+    return True
+
+
+def claim(table, run_id, record_id, flag, expires=None):
+    """
+    Set a flag on a bookkeeping item, if it is not set yet
+    Args:
+        expires: seconds after which the flag can be claimed again, for claims of invocations which may time out
+    Returns:
+        True for the one caller which set the flag, False for everyone else
+    """
+    condition = "attribute_exists(run_id) AND attribute_not_exists(#flag)"
+    values = {':value': True}
+    if expires is not None:
+        # the flag holds the time the claim expires
+        now = Decimal(str(round(time.time(), 3)))
+        condition = "attribute_exists(run_id) AND (attribute_not_exists(#flag) OR #flag < :now)"
+        values = {':value': now + expires, ':now': now}
+    try:
+        table.update_item(
+            Key={'run_id': run_id, 'job_id': record_id},
+            UpdateExpression="SET #flag = :value",
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#flag': flag},
+            ExpressionAttributeValues=values)
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+def release(table, run_id, record_id, flag):
+    """Remove a flag set by claim, e.g. when the claimed work failed"""
+    table.update_item(
+        Key={'run_id': run_id, 'job_id': record_id},
+        UpdateExpression="REMOVE #flag",
+        ExpressionAttributeNames={'#flag': flag})
+
+
+def cancel_run(table, run_id, reason):
+    """
+    Cancel a run, the executors drop its shards which are not started yet
+    and stop the running ones, see the fail_fast listener of the executor
+    The reason of the first cancellation is kept
+    Raises:
+        ClientError with the code ConditionalCheckFailedException if the run has no run record
+    """
+    table.update_item(
+        Key={'run_id': run_id, 'job_id': RUN_RECORD},
+        UpdateExpression="SET cancelled = :true, cancel_reason = if_not_exists(cancel_reason, :reason)",
+        ConditionExpression="attribute_exists(run_id)",
+        ExpressionAttributeValues={':true': True, ':reason': reason})
+
+
+def failure_threshold_exceeded(run_record, executed=0, failed=0):
+    """
+    Check the failure threshold of a run, e.g. {"max_failures": 50, "max_failure_rate": 0.5, "min_tests": 20}
+    max_failures is the number of failed tests, max_failure_rate the share of failed tests,
+    which is only checked once at least min_tests (default 20) tests are executed
+    Args:
+        run_record: the run record with the failure_threshold and the tests_executed and tests_failed counters
+        executed: tests executed in addition to the counters, e.g. by a running shard
+        failed: tests failed in addition to the counters
+    Returns:
+        the reason if the threshold is exceeded, otherwise None
+    """
+    threshold = run_record.get('failure_threshold')
+    if not threshold:
+        return None
+    executed += int(run_record.get('tests_executed', 0))
+    failed += int(run_record.get('tests_failed', 0))
+    if 'max_failures' in threshold and failed > int(threshold['max_failures']):
+        return f"{failed} failed tests exceed max_failures {threshold['max_failures']}"
+    if 'max_failure_rate' in threshold and executed >= max(1, int(threshold.get('min_tests', 20))) \
+            and failed / executed > float(threshold['max_failure_rate']):
+        return f"{failed} of {executed} failed tests exceed max_failure_rate {threshold['max_failure_rate']}"
+    return None
+
+
+def update_progress(table, run_id, shard_number=None, shard=None, append=None, max_items=None):
+    """
+    Update the progress record of a run and count the update
+    Args:
+        shard_number: the number of the shard whose entry in the shards map is updated,
+            the distributor creates the entries of all shards
+        shard: the fields of the entry which are set, the other fields are kept,
+            e.g. {'status': 'EXECUTED', 'elapsed': 12.5, 'passed': 10, 'failed': 1, 'skipped': 0}
+        append: dict of list attributes to the items which are appended, e.g. {'failed_tests': [...]}
+        max_items: only append while the first list of append has less items
+    Returns:
+        False if the run has no progress record or the list is full, otherwise True
+    """
+    names, values, updates = {}, {':one': 1}, []
+    if shard_number is not None and shard is not None:
+        names.update({'#shards': 'shards', '#number': str(shard_number)})
+        for number, (field, value) in enumerate(shard.items()):
+            names[f'#field{number}'] = field
+            values[f':field{number}'] = value
+            updates.append(f'#shards.#number.#field{number} = :field{number}')
+    for number, (attribute, items) in enumerate((append or {}).items()):
+        names[f'#list{number}'] = attribute
+        values.update({f':list{number}': list(items), ':empty': []})
+        updates.append(f'#list{number} = list_append(if_not_exists(#list{number}, :empty), :list{number})')
+    condition = 'attribute_exists(run_id)'
+    if max_items is not None and append:
+        values[':max'] = max_items
+        condition += ' AND (attribute_not_exists(#list0) OR size(#list0) < :max)'
+    arguments = {'ExpressionAttributeNames': names} if names else {}
+    try:
+        table.update_item(
+            Key={'run_id': run_id, 'job_id': PROGRESS_RECORD},
+            UpdateExpression=('SET ' + ', '.join(updates) + ' ' if updates else '') + 'ADD updates :one',
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values,
+            **arguments)
+    except ClientError as err:
+        if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
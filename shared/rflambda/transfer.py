@@ -0,0 +1,142 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from rflambda.metrics import count
+
+# Number of parallel S3 requests of one transfer, can be tuned per function in template.yaml
+DEFAULT_CONCURRENCY = int(os.environ.get('S3TransferConcurrency', 16))
+
+# Objects are transferred in parallel, so every single object is transferred in one thread
+SINGLE_THREAD_TRANSFER = TransferConfig(use_threads=False)
+# Only large files, like the output.xml of a big run, are split into parts, a few parts in parallel
+UPLOAD_TRANSFER = TransferConfig(max_concurrency=4)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def s3_client(max_pool_connections=DEFAULT_CONCURRENCY):
+    """
+    Return an S3 client with a connection pool for max_pool_connections parallel requests
+    Clients are thread safe and are reused for the lifetime of the Lambda container
+    """
+    with _clients_lock:
+        client = _clients.get(max_pool_connections)
+        if client is None:
+            client = boto3.client('s3', config=Config(max_pool_connections=max_pool_connections,
+                                                      retries={'max_attempts': 10, 'mode': 'adaptive'}))
+            _clients[max_pool_connections] = client
+        return client
+
+
+def list_objects(bucket_name, prefix, client=None):
+    """
+    Yield all objects below a prefix, one dict with Key, ETag and Size per object
+    """
+    client = client or s3_client()
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        count('S3ListRequests')
+        yield from page.get('Contents', [])
+
+
+def download_s3_folder(bucket_name, s3_folder, local_dir=None, concurrency=DEFAULT_CONCURRENCY, exclude=()):
+    """
+    Download the contents of a folder directory with parallel requests
+    Args:
+        bucket_name: the name of the s3 bucket
+        s3_folder: the folder path in the s3 bucket
+        local_dir: a relative or absolute directory path in the local file system
+        concurrency: the maximum number of parallel downloads
+        exclude: folder paths relative to s3_folder which are not downloaded, e.g. ('allure-results/',)
+    Returns:
+        tuple of the number of downloaded objects and bytes
+    """
+    client = s3_client(concurrency)
+    downloads = []
+    for obj in list_objects(bucket_name, s3_folder, client):
+        relative_path = os.path.relpath(obj['Key'], s3_folder)
+        if any(relative_path.startswith(prefix) for prefix in exclude):
+            continue
+        target = obj['Key'] if local_dir is None else os.path.join(local_dir, relative_path)
+        # create the folders up front, the worker threads only write files
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        if obj['Key'][-1] == '/':
+            continue
+        downloads.append((obj['Key'], target, obj['Size']))
+    download_all(client, bucket_name, [(key, target) for key, target, _ in downloads], concurrency)
+    return len(downloads), sum(size for _, _, size in downloads)
+
+
+def download_files(bucket_name, keys, local_dir, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Download single objects in parallel into one folder, named by the last part of their key
+    Returns:
+        list of the local file paths in the order of keys
+    """
+    os.makedirs(local_dir, exist_ok=True)
+    downloads = [(key, os.path.join(local_dir, os.path.basename(key))) for key in keys]
+    download_all(s3_client(concurrency), bucket_name, downloads, concurrency)
+    return [target for _, target in downloads]
+
+
+def download_all(client, bucket_name, downloads, concurrency):
+    """Download a list of (key, local path) tuples with at most concurrency parallel requests"""
+    def download(item):
+        key, target = item
+        client.download_file(bucket_name, key, target, Config=SINGLE_THREAD_TRANSFER)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        # list() re-raises the first failed download
+        list(pool.map(download, downloads))
+    count('S3DownloadObjects', len(downloads))
+    count('S3DownloadBytes', sum(os.path.getsize(target) for _, target in downloads))
+
+
+def upload_s3_folder(bucket_name, s3_folder, local_dir, concurrency=DEFAULT_CONCURRENCY, skip_existing=False):
+    """
+    Upload the contents of a folder directory with parallel requests
+    Files above the multipart threshold of boto3 (8 MB) are uploaded in parts.
+    Args:
+        bucket_name: the name of the s3 bucket
+        s3_folder: the folder path in the s3 bucket
+        local_dir: a relative or absolute directory path in the local file system
+        concurrency: the maximum number of parallel uploads
+        skip_existing: skip files whose key already exists, checked with one listing of s3_folder
+    Returns:
+        tuple of the number of uploaded files and bytes
+    Raises:
+        RuntimeError listing every file which could not be uploaded
+    """
+    client = s3_client(concurrency)
+    existing = set()
+    if skip_existing:
+        existing = {obj['Key'] for obj in list_objects(bucket_name, s3_folder.rstrip('/') + '/', client)}
+    uploads = []
+    for root, dirs, files in os.walk(local_dir):
+        for filename in files:
+            local_path = os.path.join(root, filename)
+            key = os.path.join(s3_folder, os.path.relpath(local_path, local_dir))
+            if key in existing:
+                print(f"Path found on S3! Skipping {key}")
+                continue
+            uploads.append((local_path, key, os.path.getsize(local_path)))
+
+    def upload(item):
+        local_path, key, _ = item
+        try:
+            client.upload_file(local_path, bucket_name, key, Config=UPLOAD_TRANSFER)
+        except Exception as err:
+            return f"{local_path} -> s3://{bucket_name}/{key}: {err}"
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        errors = [error for error in pool.map(upload, uploads) if error]
+    count('S3UploadObjects', len(uploads) - len(errors))
+    count('S3UploadBytes', sum(size for _, _, size in uploads))
+    if errors:
+        raise RuntimeError(f"Couldn't upload {len(errors)} of {len(uploads)} files:\n" + "\n".join(errors))
+    return len(uploads), sum(size for _, _, size in uploads)